@@ -0,0 +1,161 @@
+# batcher.py
+"""
+Dynamic micro-batching for captioning.
+
+Every caption request, from any session, goes through one queue. A single
+worker thread takes the first pending image, waits up to
+CAPTION_BATCH_WAIT_MS for more (or until CAPTION_BATCH_SIZE of them) and
+captions them all in one batched generate() call. Concurrent requests
+then share a forward pass instead of running back to back and fighting
+over torch's intra-op threads; a lone request only pays the short wait.
+
+    caption(img)            -> str        (blocks the caller)
+    caption_many(images)    -> [str]      (all queued at once, so they batch together)
+    submit(img)             -> Future     (collect with wait(), which cancels on timeout)
+
+If a batched call fails, its images are retried one by one so only the
+bad image fails.
+"""
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import List
+
+from captioning.model import get_captioner
+
+log = logging.getLogger(__name__)
+
+# ----------------------------------------------------------------------
+# Settings
+# ----------------------------------------------------------------------
+CAPTION_BATCH_SIZE = int(os.getenv("CAPTION_BATCH_SIZE", "8"))
+CAPTION_BATCH_WAIT_MS = float(os.getenv("CAPTION_BATCH_WAIT_MS", "25"))
+CAPTION_TIMEOUT_S = float(os.getenv("CAPTION_TIMEOUT_S", "120"))
+
+
+# ----------------------------------------------------------------------
+# Worker
+# ----------------------------------------------------------------------
+_queue = queue.Queue()
+_worker = None
+_worker_lock = threading.Lock()
+_stats = {"requests": 0, "batches": 0, "images": 0, "failed_batches": 0,
+          "max_batch": 0, "busy_s": 0.0}
+_stats_lock = threading.Lock()
+
+
+def stats() -> dict:
+    with _stats_lock:
+        s = dict(_stats, pending=_queue.qsize())
+    s["mean_batch"] = s["images"] / s["batches"] if s["batches"] else 0.0
+    return s
+
+
+def _drain(first) -> list:
+    """The first pending request plus whatever arrives within the batch window."""
+    batch = [first]
+    deadline = time.monotonic() + CAPTION_BATCH_WAIT_MS / 1000
+    while len(batch) < CAPTION_BATCH_SIZE:
+        try:
+            # Take what is already queued without waiting, then wait out the window
+            batch.append(_queue.get_nowait())
+            continue
+        except queue.Empty:
+            pass
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            batch.append(_queue.get(timeout=remaining))
+        except queue.Empty:
+            break
+    return batch
+
+
+def _run(batch: list):
+    # Callers that gave up (timeout / cancel) don't need a caption
+    batch = [(img, fut) for img, fut in batch if fut.set_running_or_notify_cancel()]
+    if not batch:
+        return
+    started = time.monotonic()
+    try:
+        captions = get_captioner().caption_batch([img for img, _ in batch])
+    except Exception as e:
+        log.warning("Captioning a batch of %d failed: %s", len(batch), e)
+        with _stats_lock:
+            _stats["failed_batches"] += 1
+        if len(batch) == 1:
+            batch[0][1].set_exception(e)
+        else:
+            _run_singly(batch)
+        return
+    for (_, fut), text in zip(batch, captions):
+        fut.set_result(text)
+    with _stats_lock:
+        _stats["batches"] += 1
+        _stats["images"] += len(batch)
+        _stats["max_batch"] = max(_stats["max_batch"], len(batch))
+        _stats["busy_s"] += time.monotonic() - started
+
+
+def _run_singly(batch: list):
+    # One bad image must not fail the requests it happened to share a batch with
+    for img, fut in batch:
+        try:
+            fut.set_result(get_captioner().caption(img))
+        except Exception as e:
+            fut.set_exception(e)
+
+
+def _loop():
+    while True:
+        _run(_drain(_queue.get()))
+
+
+def start_worker() -> threading.Thread:
+    """Start the captioning thread once per process."""
+    global _worker
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=_loop, name="caption-worker", daemon=True)
+            _worker.start()
+    return _worker
+
+
+def submit(img) -> Future:
+    """Queue one image; the Future resolves to its caption."""
+    start_worker()
+    fut = Future()
+    _queue.put((img, fut))
+    with _stats_lock:
+        _stats["requests"] += 1
+    return fut
+
+
+def wait(futures: List[Future], timeout: float | None = CAPTION_TIMEOUT_S) -> List[str]:
+    """
+    Results of submitted futures; raises on the first failure. On timeout
+    the outstanding ones are cancelled, so the worker skips them.
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    try:
+        return [
+            fut.result(None if deadline is None else max(0.0, deadline - time.monotonic()))
+            for fut in futures
+        ]
+    except TimeoutError:
+        for fut in futures:
+            fut.cancel()
+        raise
+
+
+def caption(img, timeout: float | None = CAPTION_TIMEOUT_S) -> str:
+    return wait([submit(img)], timeout)[0]
+
+
+def caption_many(images: List, timeout: float | None = CAPTION_TIMEOUT_S) -> List[str]:
+    """Caption several images; raises on the first failure."""
+    return wait([submit(img) for img in images], timeout)
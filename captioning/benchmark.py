@@ -0,0 +1,93 @@
+# benchmark.py
+"""
+Compare captioning backends on a folder of images.
+
+    python -m captioning.benchmark path/to/images
+    python -m captioning.benchmark path/to/images --backends eager,int8,onnx --threads 4 --batch 4
+
+Each backend is loaded fresh and warmed up on one image, then captions
+every image --runs times. Reported per backend: load time, per-call
+latency (p50/p95), images per second, and agreement with the eager
+float32 baseline – exact caption matches and mean word-level similarity.
+"""
+import argparse
+import difflib
+import os
+import time
+from typing import List
+
+from captioning.model import BACKENDS, CAPTION_THREADS, load
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp", ".bmp")
+
+
+def _images(folder: str, limit: int) -> List:
+    from PIL import Image
+    names = sorted(n for n in os.listdir(folder) if n.lower().endswith(IMAGE_EXTENSIONS))[:limit]
+    if not names:
+        raise SystemExit(f"No images in {folder}")
+    return [Image.open(os.path.join(folder, n)).convert("RGB") for n in names]
+
+
+def _percentile(samples: List[float], q: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def _similarity(a: str, b: str) -> float:
+    return difflib.SequenceMatcher(None, a.split(), b.split()).ratio()
+
+
+def bench(backend: str, images: List, runs: int, batch: int, threads: int) -> dict:
+    captioner = load(backend, threads)
+    captioner.caption(images[0])  # warm-up (compilation, first-run allocations)
+
+    latencies, captions = [], []
+    started = time.perf_counter()
+    for run in range(runs):
+        for i in range(0, len(images), batch):
+            t = time.perf_counter()
+            out = captioner.caption_batch(images[i:i + batch])
+            latencies.append(time.perf_counter() - t)
+            if run == 0:
+                captions.extend(out)
+    elapsed = time.perf_counter() - started
+    return {
+        "backend": captioner.backend,
+        "load_s": captioner.load_s,
+        "p50_s": _percentile(latencies, 0.5),
+        "p95_s": _percentile(latencies, 0.95),
+        "images_per_s": runs * len(images) / elapsed,
+        "captions": captions,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Latency and caption agreement per captioning backend.")
+    parser.add_argument("images", help="folder of images")
+    parser.add_argument("--backends", default=",".join(BACKENDS))
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--batch", type=int, default=1, help="images per generate() call")
+    parser.add_argument("--threads", type=int, default=CAPTION_THREADS, help="intra-op threads (0 = default)")
+    parser.add_argument("--limit", type=int, default=50, help="max images")
+    args = parser.parse_args()
+
+    images = _images(args.images, args.limit)
+    backends = [b.strip() for b in args.backends.split(",") if b.strip()]
+    if "eager" not in backends:
+        backends.insert(0, "eager")  # the reference for agreement
+
+    results = {b: bench(b, images, args.runs, args.batch, args.threads) for b in backends}
+    baseline = results["eager"]["captions"]
+
+    print(f"{len(images)} images, batch {args.batch}, {args.runs} run(s), threads {args.threads or 'default'}")
+    print(f"{'backend':<10}{'ran as':<10}{'load':>8}{'p50':>10}{'p95':>10}{'img/s':>8}{'exact':>8}{'similar':>9}")
+    for requested, r in results.items():
+        exact = sum(a == b for a, b in zip(r["captions"], baseline)) / len(baseline)
+        similar = sum(_similarity(a, b) for a, b in zip(r["captions"], baseline)) / len(baseline)
+        print(f"{requested:<10}{r['backend']:<10}{r['load_s']:>7.1f}s{r['p50_s'] * 1000:>8.0f}ms"
+              f"{r['p95_s'] * 1000:>8.0f}ms{r['images_per_s']:>8.2f}{exact:>8.0%}{similar:>9.0%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+# cache.py
+"""
+Caption cache keyed by a perceptual hash of the image.
+
+Re-uploads of the same picture – re-encoded, resized or recompressed –
+usually get the same 64-bit difference hash, so their caption is served
+from SQLite instead of running BLIP again. The cache is shared by every
+session, so only exact hash matches count, and images whose hash carries
+little information are never cached: flat or nearly flat images (blank
+screenshots, dark photos, solid backgrounds) and near-uniform gradients
+all hash to almost the same value and would otherwise share a caption.
+
+Entries unused for CAPTION_CACHE_TTL_S expire and the least recently used are
+evicted beyond CAPTION_CACHE_MAX_ENTRIES. Captions are stored per
+CAPTION_MODEL. stats() reports hits, misses and skipped (uncacheable) images.
+"""
+import logging
+import os
+import threading
+import time
+from typing import List
+
+from captioning.model import CAPTION_MODEL
+from data_base.database import pool
+
+log = logging.getLogger(__name__)
+
+# ----------------------------------------------------------------------
+# Settings
+# ----------------------------------------------------------------------
+CAPTION_CACHE = os.getenv("CAPTION_CACHE", "1") != "0"
+CAPTION_CACHE_MAX_ENTRIES = int(os.getenv("CAPTION_CACHE_MAX_ENTRIES", "10000"))
+CAPTION_CACHE_TTL_S = float(os.getenv("CAPTION_CACHE_TTL_S", str(30 * 24 * 3600)))
+EVICT_EVERY = 64              # stores between eviction passes
+
+HASH_SIZE = 8                 # 8x8 gradient bits
+MIN_CONTRAST = 12             # grey levels between the darkest and brightest cell
+MIN_BITS = 8                  # set (and unset) bits; fewer = near-uniform gradient
+
+_stats = {"hits": 0, "misses": 0, "skipped": 0, "stores": 0, "evicted": 0}
+_stats_lock = threading.Lock()
+
+
+def stats() -> dict:
+    with _stats_lock:
+        s = dict(_stats)
+    lookups = s["hits"] + s["misses"]
+    s["hit_rate"] = s["hits"] / lookups if lookups else 0.0
+    return s
+
+
+def _bump(key: str, n: int = 1):
+    with _stats_lock:
+        _stats[key] += n
+
+
+# ----------------------------------------------------------------------
+# Perceptual hash
+# ----------------------------------------------------------------------
+def dhash(img) -> int | None:
+    """
+    64-bit difference hash: is each pixel brighter than its right neighbour?
+    None for images too flat or too uniform for the hash to identify them.
+    """
+    from PIL import Image
+    small = img.convert("L").resize((HASH_SIZE + 1, HASH_SIZE), Image.Resampling.LANCZOS)
+    px = list(small.getdata())
+    if max(px) - min(px) < MIN_CONTRAST:
+        return None
+    h = 0
+    for row in range(HASH_SIZE):
+        for col in range(HASH_SIZE):
+            left = px[row * (HASH_SIZE + 1) + col]
+            h = (h << 1) | (left > px[row * (HASH_SIZE + 1) + col + 1])
+    if not MIN_BITS <= bin(h).count("1") <= HASH_SIZE * HASH_SIZE - MIN_BITS:
+        return None
+    return h
+
+
+def _signed(h: int) -> int:
+    # SQLite integers are signed 64-bit
+    return h - (1 << 64) if h >= 1 << 63 else h
+
+
+# ----------------------------------------------------------------------
+# Lookup / store
+# ----------------------------------------------------------------------
+def lookup(h: int) -> str | None:
+    """Cached caption for exactly this image hash."""
+    if not CAPTION_CACHE:
+        return None
+    now = time.time()
+    with pool.reader() as c:
+        row = c.execute(
+            """SELECT caption FROM caption_cache
+               WHERE model = ? AND phash = ? AND last_used_at > ?""",
+            (CAPTION_MODEL, _signed(h), now - CAPTION_CACHE_TTL_S),
+        ).fetchone()
+    if row is None:
+        _bump("misses")
+        return None
+
+    _bump("hits")
+    with pool.writer() as c:
+        c.execute(
+            "UPDATE caption_cache SET hits = hits + 1, last_used_at = ? WHERE model = ? AND phash = ?",
+            (now, CAPTION_MODEL, _signed(h)),
+        )
+    return row["caption"]
+
+
+def store(h: int, caption: str):
+    if not CAPTION_CACHE:
+        return
+    now = time.time()
+    with pool.writer() as c:
+        c.execute(
+            """INSERT INTO caption_cache (model, phash, caption, created_at, last_used_at)
+               VALUES (?, ?, ?, ?, ?)
+               ON CONFLICT(model, phash) DO UPDATE SET
+                   caption = excluded.caption, last_used_at = excluded.last_used_at""",
+            (CAPTION_MODEL, _signed(h), caption, now, now),
+        )
+    _bump("stores")
+    if stats()["stores"] % EVICT_EVERY == 1:
+        evict()
+
+
+def evict() -> int:
+    """Drop expired entries, then the least recently used beyond the cap."""
+    with pool.writer() as c:
+        n = c.execute(
+            "DELETE FROM caption_cache WHERE last_used_at <= ?", (time.time() - CAPTION_CACHE_TTL_S,)
+        ).rowcount
+        n += c.execute(
+            """DELETE FROM caption_cache WHERE rowid IN (
+                   SELECT rowid FROM caption_cache ORDER BY last_used_at DESC LIMIT -1 OFFSET ?
+               )""",
+            (CAPTION_CACHE_MAX_ENTRIES,),
+        ).rowcount
+    if n:
+        _bump("evicted", n)
+        log.info("Evicted %d cached captions", n)
+    return n
+
+
+def hashes(images: List) -> List[int | None]:
+    """dhash per image; None where it is uncacheable or hashing failed."""
+    out = []
+    for img in images:
+        try:
+            h = dhash(img)
+        except Exception as e:
+            log.warning("Perceptual hash failed: %s", e)
+            h = None
+        if h is None:
+            _bump("skipped")
+        out.append(h)
+    return out
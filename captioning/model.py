@@ -0,0 +1,188 @@
+# model.py
+"""
+Process-wide BLIP captioner, loaded on first use.
+
+Importing torch/transformers and loading the weights takes seconds, so
+nothing heavy happens at import time: get_captioner() loads the model
+once per process (Streamlit reruns and every session share it). With
+CAPTION_WARMUP=1, warm_up() does that in a background thread at boot so
+the first caption doesn't pay for it; by default chat-only processes
+never import torch. is_ready() tells the UI whether the model is loaded.
+
+CAPTION_BACKEND picks the CPU inference mode, trading speed for fidelity:
+
+    eager     float32 PyTorch (reference)
+    int8      dynamic int8 quantization of the Linear layers
+    compile   torch.compile of the vision encoder and text decoder
+    onnx      vision encoder exported to ONNX and run with onnxruntime
+              (optional dependency); the decoder stays in PyTorch
+
+A backend that can't be set up falls back to eager with a warning;
+Captioner.backend says what is actually running. CAPTION_THREADS sets
+torch's (and onnxruntime's) intra-op thread count. Compare backends with
+`python -m captioning.benchmark`.
+"""
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, List
+
+log = logging.getLogger(__name__)
+
+# ----------------------------------------------------------------------
+# Settings
+# ----------------------------------------------------------------------
+CAPTION_MODEL = os.getenv("CAPTION_MODEL", "Salesforce/blip-image-captioning-base")
+CAPTION_MAX_NEW_TOKENS = int(os.getenv("CAPTION_MAX_NEW_TOKENS", "20"))
+CAPTION_WARMUP = os.getenv("CAPTION_WARMUP", "0") != "0"     # opt-in: load in the background at boot
+CAPTION_BACKEND = os.getenv("CAPTION_BACKEND", "eager")       # eager | int8 | compile | onnx
+CAPTION_THREADS = int(os.getenv("CAPTION_THREADS", "0"))      # 0 = torch default
+CAPTION_ONNX_DIR = os.getenv("CAPTION_ONNX_DIR", os.path.join(".cache", "caption-onnx"))
+
+BACKENDS = ("eager", "int8", "compile", "onnx")
+
+
+@dataclass
+class Captioner:
+    processor: Any
+    model: Any
+    load_s: float
+    backend: str = "eager"
+
+    def caption(self, img) -> str:
+        return self.caption_batch([img])[0]
+
+    def caption_batch(self, images: List) -> List[str]:
+        """One generate() call for all images (BLIP resizes them to one shape)."""
+        import torch
+        inputs = self.processor(images=list(images), return_tensors="pt")
+        with torch.inference_mode():
+            out = self.model.generate(**inputs, max_new_tokens=CAPTION_MAX_NEW_TOKENS)
+        return [c.strip() for c in self.processor.batch_decode(out, skip_special_tokens=True)]
+
+
+_captioner = None
+_load_error = None
+_lock = threading.Lock()
+
+
+# ----------------------------------------------------------------------
+# Inference backends
+# ----------------------------------------------------------------------
+def _quantize_int8(model, processor):
+    import torch
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def _compile(model, processor):
+    import torch
+    # generate() calls these modules' forwards directly; compile those
+    model.vision_model.forward = torch.compile(model.vision_model.forward)
+    model.text_decoder.forward = torch.compile(model.text_decoder.forward, dynamic=True)
+    return model
+
+
+def _onnx_vision(model, processor):
+    import torch
+    import onnxruntime as ort
+
+    size = processor.image_processor.size
+    name = CAPTION_MODEL.replace("/", "--")
+    path = os.path.join(CAPTION_ONNX_DIR, f"{name}-vision-{size['height']}x{size['width']}.onnx")
+    if not os.path.exists(path):
+        class Encoder(torch.nn.Module):
+            def __init__(self, vision):
+                super().__init__()
+                self.vision = vision
+
+            def forward(self, pixel_values):
+                return self.vision(pixel_values=pixel_values)[0]
+
+        os.makedirs(CAPTION_ONNX_DIR, exist_ok=True)
+        dummy = torch.zeros(1, 3, size["height"], size["width"])
+        torch.onnx.export(
+            Encoder(model.vision_model), (dummy,), path,
+            input_names=["pixel_values"], output_names=["last_hidden_state"],
+            dynamic_axes={"pixel_values": {0: "batch"}, "last_hidden_state": {0: "batch"}},
+            opset_version=17,
+        )
+        log.info("Exported the vision encoder to %s", path)
+
+    options = ort.SessionOptions()
+    if CAPTION_THREADS:
+        options.intra_op_num_threads = CAPTION_THREADS
+    session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+
+    class OrtVision(torch.nn.Module):
+        def forward(self, pixel_values, **kwargs):
+            (hidden,) = session.run(None, {"pixel_values": pixel_values.numpy()})
+            return (torch.from_numpy(hidden),)
+
+    model.vision_model = OrtVision()
+    return model
+
+
+_BACKEND_SETUP = {"int8": _quantize_int8, "compile": _compile, "onnx": _onnx_vision}
+
+
+def load(backend: str = CAPTION_BACKEND, threads: int = CAPTION_THREADS) -> Captioner:
+    """Load a fresh captioner (get_captioner() is the shared one)."""
+    started = time.monotonic()
+    import torch
+    from transformers import BlipProcessor, BlipForConditionalGeneration
+    if threads:
+        torch.set_num_threads(threads)
+    processor = BlipProcessor.from_pretrained(CAPTION_MODEL)
+    model = BlipForConditionalGeneration.from_pretrained(CAPTION_MODEL).eval()
+    if backend != "eager":
+        try:
+            model = _BACKEND_SETUP[backend](model, processor)
+        except Exception as e:
+            log.warning("Caption backend %r unavailable, using eager: %s", backend, e)
+            model = BlipForConditionalGeneration.from_pretrained(CAPTION_MODEL).eval()
+            backend = "eager"
+    captioner = Captioner(processor, model, time.monotonic() - started, backend)
+    log.info("Loaded %s (%s) in %.1fs", CAPTION_MODEL, backend, captioner.load_s)
+    return captioner
+
+
+def get_captioner() -> Captioner:
+    """The shared captioner; the first caller loads it (others wait)."""
+    global _captioner, _load_error
+    if _captioner is None:
+        with _lock:
+            if _captioner is None:
+                try:
+                    _captioner = load()
+                    _load_error = None
+                except Exception as e:
+                    _load_error = e
+                    raise
+    return _captioner
+
+
+def is_ready() -> bool:
+    return _captioner is not None
+
+
+def load_error() -> Exception | None:
+    """Why the last load failed, if it did."""
+    return _load_error
+
+
+def warm_up(background: bool = True):
+    """Load the captioner ahead of the first caption request."""
+    def _warm():
+        try:
+            from PIL import Image
+            # One caption also triggers torch.compile / onnxruntime's first-run setup
+            get_captioner().caption(Image.new("RGB", (64, 64)))
+        except Exception as e:
+            log.warning("Captioner warm-up failed: %s", e)
+
+    if background:
+        threading.Thread(target=_warm, name="caption-warmup", daemon=True).start()
+    else:
+        _warm()
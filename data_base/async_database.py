@@ -0,0 +1,235 @@
+# async_database.py
+"""
+Async twin of data_base.database on aiosqlite.
+
+Same semantics and return shapes as the sync helpers, so the LangGraph
+backend (or an API server) can await DB I/O alongside LLM calls. The write
+path reuses the sync module's SQL and message preparation.
+
+A pool binds to the event loop that first uses it; create one per loop.
+"""
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import List, Dict
+
+import aiosqlite
+
+from data_base.connection import BUSY_TIMEOUT_MS, SYNCHRONOUS, MAX_READERS, WriteLockStats
+from data_base.database import (
+    DB_PATH,
+    RESERVE_IDX_SQL,
+    NEXT_IDX_FALLBACK_SQL,
+    INSERT_MEDIA_SQL,
+    INSERT_MESSAGE_SQL,
+    _prepare_messages,
+    _message_dict,
+)
+
+
+class AsyncConnectionPool:
+    """One serialized writer + a bounded pool of reader connections (WAL)."""
+
+    def __init__(self, path: str, busy_timeout_ms: int = BUSY_TIMEOUT_MS,
+                 synchronous: str = SYNCHRONOUS, max_readers: int = MAX_READERS):
+        self.path = path
+        self.busy_timeout_ms = busy_timeout_ms
+        self.synchronous = synchronous
+        self.max_readers = max(1, max_readers)
+
+        self._writer = None
+        self._write_lock = None
+        self._readers = None
+        self._reader_count = 0
+        self._all = []
+        self.write_stats = WriteLockStats()
+
+    def _bind(self):
+        # asyncio primitives must be created inside the running loop
+        if self._write_lock is None:
+            self._write_lock = asyncio.Lock()
+            self._readers = asyncio.LifoQueue()
+
+    async def connect(self, autocommit: bool = True) -> aiosqlite.Connection:
+        """Open a configured connection (see ConnectionPool.connect for autocommit)."""
+        c = await aiosqlite.connect(
+            self.path, timeout=self.busy_timeout_ms / 1000,
+            isolation_level=None if autocommit else "",
+        )
+        c.row_factory = aiosqlite.Row
+        await c.execute("PRAGMA journal_mode=WAL")
+        await c.execute(f"PRAGMA busy_timeout={int(self.busy_timeout_ms)}")
+        await c.execute(f"PRAGMA synchronous={self.synchronous}")
+        await c.execute("PRAGMA temp_store=MEMORY")
+        self._all.append(c)
+        return c
+
+    @asynccontextmanager
+    async def writer(self):
+        """Yield the writer connection inside a `BEGIN IMMEDIATE` transaction."""
+        self._bind()
+        requested = time.perf_counter()
+        async with self._write_lock:
+            if self._writer is None:
+                self._writer = await self.connect()
+            c = self._writer
+            await c.execute("BEGIN IMMEDIATE")
+            began = time.perf_counter()
+            try:
+                yield c
+            except BaseException:
+                await c.execute("ROLLBACK")
+                raise
+            else:
+                await c.execute("COMMIT")
+            finally:
+                self.write_stats.record(began - requested, time.perf_counter() - began)
+
+    @asynccontextmanager
+    async def reader(self):
+        self._bind()
+        if self._readers.empty() and self._reader_count < self.max_readers:
+            self._reader_count += 1
+            c = await self.connect()
+        else:
+            c = await self._readers.get()
+        try:
+            yield c
+        finally:
+            self._readers.put_nowait(c)
+
+    async def close_all(self):
+        conns, self._all = self._all, []
+        self._writer = None
+        self._write_lock = None
+        self._readers = None
+        self._reader_count = 0
+        for c in conns:
+            await c.close()
+
+
+pool = AsyncConnectionPool(DB_PATH)
+
+
+async def checkpointer_connection() -> aiosqlite.Connection:
+    """Dedicated WAL connection for LangGraph's AsyncSqliteSaver (it serializes its own access)."""
+    return await pool.connect(autocommit=False)
+
+
+# ----------------------------------------------------------------------
+# User Helpers
+# ----------------------------------------------------------------------
+async def _fetchone(sql: str, params: tuple = ()):
+    async with pool.reader() as c:
+        async with c.execute(sql, params) as cur:
+            return await cur.fetchone()
+
+async def _fetchall(sql: str, params: tuple = ()):
+    async with pool.reader() as c:
+        async with c.execute(sql, params) as cur:
+            return await cur.fetchall()
+
+async def get_user_by_username(username: str):
+    row = await _fetchone("SELECT * FROM users WHERE username = ?", (username.lower(),))
+    return dict(row) if row else None
+
+async def get_user_by_email(email: str):
+    row = await _fetchone("SELECT * FROM users WHERE email = ?", (email.lower(),))
+    return dict(row) if row else None
+
+async def get_user_by_id(user_id: int):
+    # A sqlite3.Row (or None), like the sync helper – not a dict
+    return await _fetchone("SELECT * FROM users WHERE id = ?", (user_id,))
+
+# ----------------------------------------------------------------------
+# Thread & Message Helpers
+# ----------------------------------------------------------------------
+async def get_thread_list(user_id: int) -> List[Dict]:
+    rows = await _fetchall(
+        "SELECT thread_id, title, created_at FROM threads WHERE user_id = ? ORDER BY created_at DESC",
+        (user_id,)
+    )
+    return [
+        {
+            "thread_id": r["thread_id"],
+            "title": r["title"] or "New Conversation",
+            "created_at": r["created_at"]
+        }
+        for r in rows
+    ]
+
+async def create_thread(thread_id, user_id, title="New Chat"):
+    async with pool.writer() as c:
+        # Thread already exists – just update title
+        await c.execute(
+            """INSERT INTO threads (thread_id, user_id, title, created_at, last_activity_at)
+               VALUES (?, ?, ?, datetime('now'), datetime('now'))
+               ON CONFLICT(thread_id) DO UPDATE SET title = excluded.title""",
+            (thread_id, user_id, title)
+        )
+
+async def set_thread_title(thread_id: str, title: str):
+    async with pool.writer() as c:
+        await c.execute("UPDATE threads SET title = ? WHERE thread_id = ?", (title, thread_id))
+
+async def load_messages(thread_id: str) -> List[Dict]:
+    rows = await _fetchall(
+        "SELECT idx, role, content, media_hash FROM thread_messages WHERE thread_id = ? ORDER BY idx",
+        (thread_id,)
+    )
+    return [_message_dict(r) for r in rows]
+
+async def load_recent_messages(thread_id: str, limit: int = 50) -> List[Dict]:
+    return await load_messages_before(thread_id, None, limit)
+
+async def load_messages_before(thread_id: str, before_idx: int | None, limit: int = 50) -> List[Dict]:
+    if before_idx is None:
+        rows = await _fetchall(
+            """SELECT idx, role, content, media_hash FROM thread_messages
+               WHERE thread_id = ? ORDER BY idx DESC LIMIT ?""",
+            (thread_id, limit)
+        )
+    else:
+        rows = await _fetchall(
+            """SELECT idx, role, content, media_hash FROM thread_messages
+               WHERE thread_id = ? AND idx < ? ORDER BY idx DESC LIMIT ?""",
+            (thread_id, before_idx, limit)
+        )
+    return [_message_dict(r) for r in reversed(rows)]
+
+async def count_messages(thread_id: str) -> int:
+    row = await _fetchone("SELECT message_count FROM threads WHERE thread_id = ?", (thread_id,))
+    if row:
+        return row[0]
+    row = await _fetchone("SELECT COUNT(*) FROM thread_messages WHERE thread_id = ?", (thread_id,))
+    return row[0]
+
+async def append_message(thread_id: str, role: str, content: str, media: bytes | None = None) -> int:
+    return (await append_messages(
+        thread_id, [{"role": role, "content": content, "media": media}]
+    ))[0]
+
+async def append_messages(thread_id: str, messages: List[Dict]) -> List[int]:
+    """Async append_messages(): same atomic idx reservation, one commit."""
+    if not messages:
+        return []
+    n = len(messages)
+    preview, blobs, rows = _prepare_messages(messages)
+    async with pool.writer() as c:
+        async with c.execute(RESERVE_IDX_SQL, (n, n, preview, thread_id)) as cur:
+            row = await cur.fetchall()
+        if row:
+            first_idx = row[0][0] - n
+        else:
+            async with c.execute(NEXT_IDX_FALLBACK_SQL, (thread_id,)) as cur:
+                first_idx = (await cur.fetchone())[0]
+        await c.executemany(INSERT_MEDIA_SQL, blobs)
+        await c.executemany(
+            INSERT_MESSAGE_SQL,
+            [(thread_id, first_idx + i, *r) for i, r in enumerate(rows)]
+        )
+    return list(range(first_idx, first_idx + n))
+
+async def get_media(media_hash: str) -> bytes | None:
+    row = await _fetchone("SELECT data FROM media_blobs WHERE hash = ?", (media_hash,))
+    return bytes(row["data"]) if row else None
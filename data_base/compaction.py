@@ -0,0 +1,167 @@
+# compaction.py
+"""
+Retention and compaction for the LangGraph SqliteSaver tables.
+
+Keeps only the latest CHECKPOINT_KEEP_LAST checkpoints per thread (and
+their pending writes), drops media blobs no message references any more
+(e.g. after delete_thread), then returns free pages to the OS with
+`PRAGMA incremental_vacuum` (enabled by migration 006). Runs as a daemon
+thread started by the backend; stats() exposes what it reclaimed.
+
+    python -m data_base.compaction      # one pass, prints stats
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from data_base.database import pool, gc_media
+
+log = logging.getLogger(__name__)
+
+# ----------------------------------------------------------------------
+# Settings
+# ----------------------------------------------------------------------
+CHECKPOINT_KEEP_LAST = int(os.getenv("CHECKPOINT_KEEP_LAST", "3"))
+COMPACTION_INTERVAL_S = float(os.getenv("CHECKPOINT_COMPACTION_INTERVAL_S", "600"))
+DELETE_BATCH = 500          # rows per write transaction, keeps writer stalls short
+VACUUM_PAGES = 2000         # pages handed back per incremental_vacuum step
+
+_stats = {
+    "runs": 0,
+    "checkpoints_deleted": 0,
+    "writes_deleted": 0,
+    "media_deleted": 0,
+    "freed_bytes": 0,        # bytes moved to the freelist by deletes
+    "reclaimed_bytes": 0,    # bytes the database file actually shrank by
+    "last_run_at": None,
+    "last_run_seconds": None,
+}
+_stats_lock = threading.Lock()
+
+
+def stats() -> dict:
+    with _stats_lock:
+        return dict(_stats)
+
+
+def _db_pages(c: sqlite3.Connection):
+    page_size = c.execute("PRAGMA page_size").fetchone()[0]
+    page_count = c.execute("PRAGMA page_count").fetchone()[0]
+    freelist = c.execute("PRAGMA freelist_count").fetchone()[0]
+    return page_size, page_count, freelist
+
+
+def _delete_in_batches(sql: str, rowids: list) -> int:
+    deleted = 0
+    for i in range(0, len(rowids), DELETE_BATCH):
+        batch = rowids[i:i + DELETE_BATCH]
+        with pool.writer() as c:
+            deleted += c.execute(
+                sql.format(",".join("?" * len(batch))), batch
+            ).rowcount
+    return deleted
+
+
+def compact_checkpoints(keep_last: int = CHECKPOINT_KEEP_LAST) -> dict:
+    """One retention + incremental vacuum pass. Returns this run's numbers."""
+    started = time.monotonic()
+    with pool.reader() as c:
+        try:
+            # Candidates are found on a reader (WAL), so the scan never blocks writers
+            old = [r[0] for r in c.execute(
+                """SELECT rowid FROM (
+                       SELECT rowid, ROW_NUMBER() OVER (
+                           PARTITION BY thread_id, checkpoint_ns ORDER BY checkpoint_id DESC
+                       ) AS rn
+                       FROM checkpoints
+                   ) WHERE rn > ?""",
+                (keep_last,)
+            ).fetchall()]
+        except sqlite3.OperationalError:
+            return {}  # checkpointer hasn't created its tables yet
+        page_size, pages_before, free_before = _db_pages(c)
+
+    checkpoints_deleted = _delete_in_batches(
+        "DELETE FROM checkpoints WHERE rowid IN ({})", old
+    )
+
+    with pool.reader() as c:
+        orphans = [r[0] for r in c.execute(
+            """SELECT rowid FROM writes w WHERE NOT EXISTS (
+                   SELECT 1 FROM checkpoints k
+                   WHERE k.thread_id = w.thread_id
+                     AND k.checkpoint_ns = w.checkpoint_ns
+                     AND k.checkpoint_id = w.checkpoint_id
+               )"""
+        ).fetchall()]
+    writes_deleted = _delete_in_batches("DELETE FROM writes WHERE rowid IN ({})", orphans)
+    media_deleted = gc_media()
+
+    with pool.reader() as c:
+        _, _, free_after_delete = _db_pages(c)
+        incremental = c.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+    freelist = free_after_delete
+    while incremental and freelist:
+        # Small steps so other writers get the lock in between
+        with pool.writer() as c:
+            c.execute(f"PRAGMA incremental_vacuum({VACUUM_PAGES})").fetchall()
+            remaining = _db_pages(c)[2]
+        if remaining >= freelist:
+            break  # no progress
+        freelist = remaining
+    with pool.reader() as c:
+        _, pages_after, _ = _db_pages(c)
+
+    run = {
+        "checkpoints_deleted": checkpoints_deleted,
+        "writes_deleted": writes_deleted,
+        "media_deleted": media_deleted,
+        "freed_bytes": max(0, free_after_delete - free_before) * page_size,
+        "reclaimed_bytes": max(0, pages_before - pages_after) * page_size,
+    }
+    with _stats_lock:
+        _stats["runs"] += 1
+        for k, v in run.items():
+            _stats[k] += v
+        _stats["last_run_at"] = time.time()
+        _stats["last_run_seconds"] = time.monotonic() - started
+    if checkpoints_deleted or writes_deleted or media_deleted:
+        log.info("Checkpoint compaction: %s", run)
+    return run
+
+
+# ----------------------------------------------------------------------
+# Background job
+# ----------------------------------------------------------------------
+_compactor = None
+_compactor_lock = threading.Lock()
+
+
+def _loop(interval_s: float, keep_last: int):
+    while True:
+        try:
+            compact_checkpoints(keep_last)
+        except Exception:
+            log.exception("Checkpoint compaction failed")
+        time.sleep(interval_s)
+
+
+def start_compactor(interval_s: float = COMPACTION_INTERVAL_S,
+                    keep_last: int = CHECKPOINT_KEEP_LAST) -> threading.Thread:
+    """Start the background compaction thread once per process."""
+    global _compactor
+    with _compactor_lock:
+        if _compactor is None or not _compactor.is_alive():
+            _compactor = threading.Thread(
+                target=_loop, args=(interval_s, keep_last),
+                name="checkpoint-compactor", daemon=True,
+            )
+            _compactor.start()
+    return _compactor
+
+
+if __name__ == "__main__":
+    print(compact_checkpoints())
+    print(stats())
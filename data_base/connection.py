@@ -0,0 +1,223 @@
+# connection.py
+import os
+import queue
+import sqlite3
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# ----------------------------------------------------------------------
+# Settings (override through the environment / .env)
+# ----------------------------------------------------------------------
+BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "NORMAL").upper()   # OFF | NORMAL | FULL | EXTRA
+MAX_READERS = int(os.getenv("DB_MAX_READERS", str(os.cpu_count() or 4)))
+
+_SYNCHRONOUS_LEVELS = {"OFF", "NORMAL", "FULL", "EXTRA"}
+
+
+class WriteLockStats:
+    """
+    Wait / hold times of write transactions. Wait covers queueing on the
+    pool's lock plus SQLite's own busy wait in BEGIN IMMEDIATE (other
+    processes); hold is BEGIN to COMMIT.
+    """
+
+    def __init__(self, window: int = 10000):
+        self._lock = threading.Lock()
+        self._waits = deque(maxlen=window)
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._waits.clear()
+            self.transactions = 0
+            self.wait_total_s = 0.0
+            self.wait_max_s = 0.0
+            self.hold_total_s = 0.0
+            self.hold_max_s = 0.0
+
+    def record(self, wait_s: float, hold_s: float):
+        with self._lock:
+            self._waits.append(wait_s)
+            self.transactions += 1
+            self.wait_total_s += wait_s
+            self.wait_max_s = max(self.wait_max_s, wait_s)
+            self.hold_total_s += hold_s
+            self.hold_max_s = max(self.hold_max_s, hold_s)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            waits = sorted(self._waits)
+            n = self.transactions
+
+            def pct(q):
+                return waits[min(len(waits) - 1, int(q * len(waits)))] if waits else 0.0
+
+            return {
+                "transactions": n,
+                "wait_total_s": self.wait_total_s,
+                "wait_mean_s": self.wait_total_s / n if n else 0.0,
+                "wait_p50_s": pct(0.5),
+                "wait_p95_s": pct(0.95),
+                "wait_p99_s": pct(0.99),
+                "wait_max_s": self.wait_max_s,
+                "hold_mean_s": self.hold_total_s / n if n else 0.0,
+                "hold_max_s": self.hold_max_s,
+            }
+
+
+class ConnectionPool:
+    """
+    SQLite connection layer for the app.
+
+    - One writer connection, serialized by a lock (SQLite allows a single
+      writer anyway, so queueing here avoids SQLITE_BUSY churn).
+    - A bounded pool of reader connections. Each one is used by a single
+      thread at a time and, thanks to WAL, never waits on the writer.
+    """
+
+    def __init__(self, path: str, busy_timeout_ms: int = BUSY_TIMEOUT_MS,
+                 synchronous: str = SYNCHRONOUS, max_readers: int = MAX_READERS):
+        if synchronous not in _SYNCHRONOUS_LEVELS:
+            raise ValueError(f"Invalid synchronous level: {synchronous}")
+        self.path = path
+        self.busy_timeout_ms = busy_timeout_ms
+        self.synchronous = synchronous
+        self.max_readers = max(1, max_readers)
+
+        self._write_lock = threading.RLock()
+        self._local = threading.local()
+        self._writer = None
+        self.write_stats = WriteLockStats()
+
+        self._readers = queue.LifoQueue()
+        self._reader_count = 0
+        self._reader_lock = threading.Lock()
+        self._all = []
+
+    # ------------------------------------------------------------------
+    # Connection factory
+    # ------------------------------------------------------------------
+    def connect(self, autocommit: bool = True) -> sqlite3.Connection:
+        """
+        Open a new, fully configured connection.
+        Pool connections are autocommit (transactions are explicit); pass
+        autocommit=False for code that expects sqlite3's implicit BEGIN/commit().
+        """
+        c = sqlite3.connect(
+            self.path,
+            timeout=self.busy_timeout_ms / 1000,
+            check_same_thread=False,
+            isolation_level=None if autocommit else "",
+        )
+        c.row_factory = sqlite3.Row
+        c.execute("PRAGMA journal_mode=WAL")
+        c.execute(f"PRAGMA busy_timeout={int(self.busy_timeout_ms)}")
+        c.execute(f"PRAGMA synchronous={self.synchronous}")
+        c.execute("PRAGMA temp_store=MEMORY")
+        with self._reader_lock:
+            self._all.append(c)
+        return c
+
+    # ------------------------------------------------------------------
+    # Writer
+    # ------------------------------------------------------------------
+    @contextmanager
+    def writer(self):
+        """
+        Yield the writer connection inside a `BEGIN IMMEDIATE` transaction.
+        Commits on success, rolls back on error. Re-entrant on the same thread.
+        """
+        requested = time.perf_counter()
+        with self._write_lock:
+            if self._writer is None:
+                self._writer = self.connect()
+            c = self._writer
+
+            depth = getattr(self._local, "write_depth", 0)
+            if depth:
+                self._local.write_depth = depth + 1
+                try:
+                    yield c
+                finally:
+                    self._local.write_depth = depth
+                return
+
+            self._local.write_depth = 1
+            c.execute("BEGIN IMMEDIATE")
+            began = time.perf_counter()
+            try:
+                yield c
+            except BaseException:
+                c.execute("ROLLBACK")
+                raise
+            else:
+                c.execute("COMMIT")
+            finally:
+                self._local.write_depth = 0
+                self.write_stats.record(began - requested, time.perf_counter() - began)
+
+    @contextmanager
+    def exclusive(self):
+        """Writer connection outside any transaction (VACUUM and friends)."""
+        with self._write_lock:
+            if self._writer is None:
+                self._writer = self.connect()
+            yield self._writer
+
+    # ------------------------------------------------------------------
+    # Readers
+    # ------------------------------------------------------------------
+    @contextmanager
+    def reader(self):
+        """Check out a reader connection for the current thread. Re-entrant on the same thread."""
+        # A thread that is inside a write transaction must see its own writes.
+        if getattr(self._local, "write_depth", 0):
+            yield self._writer
+            return
+        # Nested: reuse this thread's connection (waiting for a second one
+        # could block forever once all max_readers are checked out)
+        held = getattr(self._local, "read_conn", None)
+        if held is not None:
+            yield held
+            return
+
+        c = self._checkout()
+        self._local.read_conn = c
+        try:
+            yield c
+        finally:
+            self._local.read_conn = None
+            self._readers.put(c)
+
+    def _checkout(self) -> sqlite3.Connection:
+        try:
+            return self._readers.get_nowait()
+        except queue.Empty:
+            pass
+        with self._reader_lock:
+            if self._reader_count < self.max_readers:
+                self._reader_count += 1
+                create = True
+            else:
+                create = False
+        if create:
+            return self.connect()
+        return self._readers.get()
+
+    # ------------------------------------------------------------------
+    # Shutdown
+    # ------------------------------------------------------------------
+    def close_all(self):
+        with self._reader_lock:
+            conns, self._all = self._all, []
+            self._reader_count = 0
+        self._readers = queue.LifoQueue()
+        self._writer = None
+        for c in conns:
+            try:
+                c.close()
+            except sqlite3.Error:
+                pass
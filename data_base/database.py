@@ -1,99 +1,33 @@
 # database.py
+import logging
 import sqlite3
 from typing import List, Dict
 import hashlib
+import base64
 import os
+import re
 
-DB_PATH = "chatbot1.db"
+from data_base.connection import ConnectionPool
 
-# Create connection (thread-safe for Flask/FastAPI)
-conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-conn.row_factory = sqlite3.Row
+log = logging.getLogger(__name__)
 
-# ----------------------------------------------------------------------
-# Helper: Add column if not exists
-# ----------------------------------------------------------------------
-def add_column_if_not_exists(table: str, column: str, definition: str):
-    """Safely add a column if it doesn't already exist."""
-    try:
-        with conn:
-            conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
-        print(f"[Migration] Added column: {column} to {table}")
-    except sqlite3.OperationalError as e:
-        if "duplicate column name" in str(e).lower():
-            pass  # Already exists
-        else:
-            print(f"[Migration Warning] Could not add {column}: {e}")
+DB_PATH = os.getenv("DB_PATH", "chatbot1.db")
 
-# ----------------------------------------------------------------------
-# Schema Definition
-# ----------------------------------------------------------------------
-INIT_SQL = """
--- Users table
-CREATE TABLE IF NOT EXISTS users (
-    id            INTEGER PRIMARY KEY AUTOINCREMENT,
-    username      TEXT UNIQUE NOT NULL,
-    email         TEXT UNIQUE NOT NULL,
-    password_hash TEXT NOT NULL DEFAULT '',
-    first_name    TEXT,
-    last_name     TEXT,
-    created_at    TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-);
-
--- Create unique indexes (idempotent)
-CREATE UNIQUE INDEX IF NOT EXISTS idx_users_username ON users(username);
-CREATE UNIQUE INDEX IF NOT EXISTS idx_users_email ON users(email);
-
--- Threads belong to users
-CREATE TABLE IF NOT EXISTS threads (
-    thread_id     TEXT PRIMARY KEY,
-    user_id       INTEGER NOT NULL,
-    title         TEXT DEFAULT 'New Chat',
-    created_at    TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
-);
-
--- Messages in threads
-CREATE TABLE IF NOT EXISTS thread_messages (
-    thread_id     TEXT,
-    idx           INTEGER,
-    role          TEXT CHECK(role IN ('user','assistant')),
-    content       TEXT,
-    media_b64     TEXT,
-    PRIMARY KEY (thread_id, idx),
-    FOREIGN KEY (thread_id) REFERENCES threads(thread_id) ON DELETE CASCADE
-);
-"""
+# WAL connection pool: one serialized writer + per-thread readers
+pool = ConnectionPool(DB_PATH)
+
+# Characters of the latest message kept on the thread row for the sidebar
+PREVIEW_CHARS = 80
+
+# Schema lives in data_base/migrations.py – run `python -m data_base.migrations`
+# (the app also calls migrations.upgrade() once per process at startup).
 
 # ----------------------------------------------------------------------
-# Initialize / Migrate Database
+# Checkpointer connection
 # ----------------------------------------------------------------------
-with conn:
-    conn.executescript(INIT_SQL)
-
-# --- Migration 1: Ensure critical columns exist in users table ---
-with conn:
-    cur = conn.execute("PRAGMA table_info(users)")
-    existing_columns = {row["name"] for row in cur.fetchall()}
-
-    if "password_hash" not in existing_columns:
-        add_column_if_not_exists("users", "password_hash", "TEXT NOT NULL DEFAULT ''")
-    if "first_name" not in existing_columns:
-        add_column_if_not_exists("users", "first_name", "TEXT")
-    if "last_name" not in existing_columns:
-        add_column_if_not_exists("users", "last_name", "TEXT")
-    if "created_at" not in existing_columns:
-        add_column_if_not_exists("users", "created_at", "TIMESTAMP DEFAULT CURRENT_TIMESTAMP")
-
-# --- Migration 2: Add media_b64 if missing ---
-add_column_if_not_exists("thread_messages", "media_b64", "TEXT")
-
-# --- Migration 3: Ensure default title on threads ---
-with conn:
-    try:
-        conn.execute("ALTER TABLE threads ADD COLUMN title TEXT DEFAULT 'New Chat'")
-    except sqlite3.OperationalError:
-        pass  # Already has title or default
+def checkpointer_connection() -> sqlite3.Connection:
+    """Dedicated WAL connection for LangGraph's SqliteSaver (it serializes its own access)."""
+    return pool.connect(autocommit=False)
 
 
 # ----------------------------------------------------------------------
@@ -109,8 +43,8 @@ def create_user(username: str, email: str, password: str, first_name: str = None
     """Create a new user and return user ID."""
     password_hash = hash_password(password)
     try:
-        with conn:
-            cur = conn.execute(
+        with pool.writer() as c:
+            cur = c.execute(
                 """INSERT INTO users (username, email, password_hash, first_name, last_name)
                    VALUES (?, ?, ?, ?, ?)""",
                 (username.lower(), email.lower(), password_hash, first_name, last_name)
@@ -124,32 +58,46 @@ def create_user(username: str, email: str, password: str, first_name: str = None
         raise
 
 def get_user_by_username(username: str):
-    cur = conn.execute("SELECT * FROM users WHERE username = ?", (username.lower(),))
-    row = cur.fetchone()
+    with pool.reader() as c:
+        row = c.execute("SELECT * FROM users WHERE username = ?", (username.lower(),)).fetchone()
     if row:
         return dict(row)  # Convert SQLite Row → dict with 'id', 'username', etc.
     return None
 
 def get_user_by_email(email: str):
-    cur = conn.execute("SELECT * FROM users WHERE email = ?", (email.lower(),))
-    row = cur.fetchone()
+    with pool.reader() as c:
+        row = c.execute("SELECT * FROM users WHERE email = ?", (email.lower(),)).fetchone()
     if row:
         return dict(row)
     return None
 
 def get_user_by_id(user_id: int):
-    cur = conn.execute("SELECT * FROM users WHERE id = ?", (user_id,))
-    return cur.fetchone()
+    with pool.reader() as c:
+        return c.execute("SELECT * FROM users WHERE id = ?", (user_id,)).fetchone()
+
+def update_user_name(user_id: int, first_name: str, last_name: str | None):
+    with pool.writer() as c:
+        c.execute(
+            "UPDATE users SET first_name = ?, last_name = ? WHERE id = ?",
+            (first_name, last_name, user_id)
+        )
+
+def update_user_password(user_id: int, new_password: str):
+    with pool.writer() as c:
+        c.execute(
+            "UPDATE users SET password_hash = ? WHERE id = ?",
+            (hash_password(new_password), user_id)
+        )
 
 # ----------------------------------------------------------------------
 # Thread & Message Helpers (user-scoped)
 # ----------------------------------------------------------------------
 def get_thread_list(user_id: int) -> List[Dict]:
-    cur = conn.execute(
-        "SELECT thread_id, title, created_at FROM threads WHERE user_id = ? ORDER BY created_at DESC",
-        (user_id,)
-    )
-    rows = cur.fetchall()
+    with pool.reader() as c:
+        rows = c.execute(
+            "SELECT thread_id, title, created_at FROM threads WHERE user_id = ? ORDER BY created_at DESC",
+            (user_id,)
+        ).fetchall()
     return [
         {
             "thread_id": r["thread_id"],
@@ -159,55 +107,299 @@ def get_thread_list(user_id: int) -> List[Dict]:
         for r in rows
     ]
 
+def get_thread_summaries(user_id: int, limit: int = 30, cursor: tuple | None = None):
+    """
+    One page of the sidebar: non-empty threads by latest activity.
+    Returns (threads, next_cursor); pass next_cursor back for the following
+    page. next_cursor is None on the last page.
+    """
+    with pool.reader() as c:
+        if cursor is None:
+            rows = c.execute(
+                """SELECT thread_id, title, created_at, last_activity_at, message_count, preview
+                   FROM threads
+                   WHERE user_id = ? AND message_count > 0
+                   ORDER BY last_activity_at DESC, thread_id DESC LIMIT ?""",
+                (user_id, limit)
+            ).fetchall()
+        else:
+            rows = c.execute(
+                """SELECT thread_id, title, created_at, last_activity_at, message_count, preview
+                   FROM threads
+                   WHERE user_id = ? AND message_count > 0
+                     AND (last_activity_at, thread_id) < (?, ?)
+                   ORDER BY last_activity_at DESC, thread_id DESC LIMIT ?""",
+                (user_id, cursor[0], cursor[1], limit)
+            ).fetchall()
+    threads = [
+        {
+            "thread_id": r["thread_id"],
+            "title": r["title"] or "New Conversation",
+            "created_at": r["created_at"],
+            "last_activity_at": r["last_activity_at"],
+            "message_count": r["message_count"],
+            "preview": r["preview"] or "",
+        }
+        for r in rows
+    ]
+    next_cursor = None
+    if len(rows) == limit:
+        next_cursor = (rows[-1]["last_activity_at"], rows[-1]["thread_id"])
+    return threads, next_cursor
+
+def get_thread_title(thread_id: str) -> str | None:
+    with pool.reader() as c:
+        row = c.execute("SELECT title FROM threads WHERE thread_id = ?", (thread_id,)).fetchone()
+    return row["title"] if row else None
+
 def create_thread(thread_id, user_id, title="New Chat"):
-    try:
-        conn.execute(
-            "INSERT INTO threads (thread_id, user_id, title, created_at) VALUES (?, ?, ?, datetime('now'))",
-            (thread_id, user_id, title)
-        )
-        conn.commit()
-    except sqlite3.IntegrityError:
+    with pool.writer() as c:
         # Thread already exists – just update title
-        conn.execute(
-            "UPDATE threads SET title = ? WHERE thread_id = ?",
-            (title, thread_id)
+        c.execute(
+            """INSERT INTO threads (thread_id, user_id, title, created_at, last_activity_at)
+               VALUES (?, ?, ?, datetime('now'), datetime('now'))
+               ON CONFLICT(thread_id) DO UPDATE SET title = excluded.title""",
+            (thread_id, user_id, title)
         )
-        conn.commit()
 
 def set_thread_title(thread_id: str, title: str):
-    with conn:
-        conn.execute("UPDATE threads SET title = ? WHERE thread_id = ?", (title, thread_id))
+    with pool.writer() as c:
+        c.execute("UPDATE threads SET title = ? WHERE thread_id = ?", (title, thread_id))
+
+def _message_dict(r) -> Dict:
+    return {"idx": r["idx"], "role": r["role"], "content": r["content"], "media_hash": r["media_hash"]}
 
 def load_messages(thread_id: str) -> List[Dict]:
-    cur = conn.execute(
-        "SELECT role, content, media_b64 FROM thread_messages WHERE thread_id = ? ORDER BY idx",
-        (thread_id,)
-    )
-    return [
-        {"role": r["role"], "content": r["content"], "media_b64": r["media_b64"]}
-        for r in cur.fetchall()
-    ]
+    """Messages of a thread. Images are returned as `media_hash`; fetch bytes with get_media()."""
+    with pool.reader() as c:
+        rows = c.execute(
+            "SELECT idx, role, content, media_hash FROM thread_messages WHERE thread_id = ? ORDER BY idx",
+            (thread_id,)
+        ).fetchall()
+    return [_message_dict(r) for r in rows]
+
+def load_recent_messages(thread_id: str, limit: int = 50) -> List[Dict]:
+    """Last `limit` messages, oldest first. Cost does not depend on thread length."""
+    return load_messages_before(thread_id, None, limit)
 
-def append_message(thread_id: str, role: str, content: str, media_b64: str | None = None):
-    cur = conn.execute(
-        "SELECT COALESCE(MAX(idx), -1) FROM thread_messages WHERE thread_id = ?",
-        (thread_id,)
-    )
-    next_idx = cur.fetchone()[0] + 1
-    with conn:
-        conn.execute(
-            """INSERT INTO thread_messages (thread_id, idx, role, content, media_b64)
-               VALUES (?, ?, ?, ?, ?)""",
-            (thread_id, next_idx, role, content, media_b64)
+def load_messages_before(thread_id: str, before_idx: int | None, limit: int = 50) -> List[Dict]:
+    """
+    Keyset page of up to `limit` messages with idx < before_idx, oldest first.
+    Walks the (thread_id, idx) primary key backwards – no OFFSET scans.
+    """
+    with pool.reader() as c:
+        if before_idx is None:
+            rows = c.execute(
+                """SELECT idx, role, content, media_hash FROM thread_messages
+                   WHERE thread_id = ? ORDER BY idx DESC LIMIT ?""",
+                (thread_id, limit)
+            ).fetchall()
+        else:
+            rows = c.execute(
+                """SELECT idx, role, content, media_hash FROM thread_messages
+                   WHERE thread_id = ? AND idx < ? ORDER BY idx DESC LIMIT ?""",
+                (thread_id, before_idx, limit)
+            ).fetchall()
+    return [_message_dict(r) for r in reversed(rows)]
+
+def load_messages_after(thread_id: str, after_idx: int, limit: int | None = None) -> List[Dict]:
+    """Messages with idx > after_idx, oldest first (keyset, like load_messages_before)."""
+    with pool.reader() as c:
+        rows = c.execute(
+            """SELECT idx, role, content, media_hash FROM thread_messages
+               WHERE thread_id = ? AND idx > ? ORDER BY idx LIMIT ?""",
+            (thread_id, after_idx, -1 if limit is None else limit)
+        ).fetchall()
+    return [_message_dict(r) for r in rows]
+
+def get_thread_summary(thread_id: str) -> Dict | None:
+    """Rolling summary of turns up to `upto_idx`; None if the thread has no row (guests)."""
+    with pool.reader() as c:
+        row = c.execute(
+            "SELECT summary, summary_upto_idx FROM threads WHERE thread_id = ?", (thread_id,)
+        ).fetchone()
+    if row is None:
+        return None
+    return {"summary": row["summary"], "upto_idx": row["summary_upto_idx"]}
+
+def set_thread_summary(thread_id: str, summary: str, upto_idx: int) -> bool:
+    """Store a newer summary; a stale one (covering fewer messages) is ignored."""
+    with pool.writer() as c:
+        return c.execute(
+            """UPDATE threads SET summary = ?, summary_upto_idx = ?
+               WHERE thread_id = ? AND summary_upto_idx < ?""",
+            (summary, upto_idx, thread_id, upto_idx)
+        ).rowcount > 0
+
+def count_messages(thread_id: str) -> int:
+    with pool.reader() as c:
+        row = c.execute(
+            "SELECT message_count FROM threads WHERE thread_id = ?", (thread_id,)
+        ).fetchone()
+        if row:
+            return row[0]
+        # No threads row (guest chats)
+        return c.execute(
+            "SELECT COUNT(*) FROM thread_messages WHERE thread_id = ?", (thread_id,)
+        ).fetchone()[0]
+
+# Write path shared with data_base.async_database – keep the two in step
+RESERVE_IDX_SQL = """UPDATE threads SET
+                         next_idx = next_idx + ?,
+                         message_count = message_count + ?,
+                         last_activity_at = datetime('now'),
+                         preview = ?
+                     WHERE thread_id = ? RETURNING next_idx"""
+NEXT_IDX_FALLBACK_SQL = "SELECT COALESCE(MAX(idx), -1) + 1 FROM thread_messages WHERE thread_id = ?"
+INSERT_MEDIA_SQL = "INSERT OR IGNORE INTO media_blobs (hash, mime, size, data) VALUES (?, ?, ?, ?)"
+INSERT_MESSAGE_SQL = """INSERT INTO thread_messages (thread_id, idx, role, content, media_hash)
+                        VALUES (?, ?, ?, ?, ?)"""
+
+def _prepare_messages(messages: List[Dict]):
+    """
+    Split messages into (preview, media blob rows, (role, content, media_hash) rows).
+    Pure Python, so it runs before the write lock is taken.
+    """
+    preview = next(
+        (m["content"] for m in reversed(messages) if m.get("content")), ""
+    )[:PREVIEW_CHARS]
+    blobs, rows = [], []
+    for m in messages:
+        media = m.get("media")
+        if media is None and m.get("media_b64"):
+            media = base64.b64decode(m["media_b64"])
+        media_hash = None
+        if media:
+            media_hash = hashlib.sha256(media).hexdigest()
+            blobs.append((media_hash, m.get("mime", "image/png"), len(media), sqlite3.Binary(media)))
+        rows.append((m["role"], m["content"], media_hash))
+    return preview, blobs, rows
+
+def append_message(thread_id: str, role: str, content: str, media: bytes | None = None) -> int:
+    """Append one message and return its idx."""
+    return append_messages(
+        thread_id, [{"role": role, "content": content, "media": media}]
+    )[0]
+
+def append_messages(thread_id: str, messages: List[Dict]) -> List[int]:
+    """
+    Append several messages ({"role", "content", "media"?}) in one commit.
+    `media` is raw image bytes (a legacy "media_b64" string is also accepted).
+    idx values are reserved from threads.next_idx inside the same write
+    transaction, so concurrent writers to one thread never collide.
+    """
+    if not messages:
+        return []
+    n = len(messages)
+    preview, blobs, rows = _prepare_messages(messages)
+    with pool.writer() as c:
+        row = c.execute(RESERVE_IDX_SQL, (n, n, preview, thread_id)).fetchall()
+        if row:
+            first_idx = row[0][0] - n
+        else:
+            # No threads row (e.g. guest chats) – fall back to the message table
+            first_idx = c.execute(NEXT_IDX_FALLBACK_SQL, (thread_id,)).fetchone()[0]
+        c.executemany(INSERT_MEDIA_SQL, blobs)
+        c.executemany(
+            INSERT_MESSAGE_SQL,
+            [(thread_id, first_idx + i, *r) for i, r in enumerate(rows)]
         )
+    return list(range(first_idx, first_idx + n))
 
 def delete_thread(thread_id: str):
-    with conn:
-        conn.execute("DELETE FROM threads WHERE thread_id = ?", (thread_id,))
+    with pool.writer() as c:
+        # foreign_keys is off, so clear messages explicitly (lets gc_media reclaim
+        # images; the compactor runs it)
+        c.execute("DELETE FROM thread_messages WHERE thread_id = ?", (thread_id,))
+        c.execute("DELETE FROM threads WHERE thread_id = ?", (thread_id,))
 
 def thread_belongs_to_user(thread_id: str, user_id: int) -> bool:
-    cur = conn.execute(
-        "SELECT 1 FROM threads WHERE thread_id = ? AND user_id = ?",
-        (thread_id, user_id)
-    )
-    return cur.fetchone() is not None
\ No newline at end of file
+    with pool.reader() as c:
+        row = c.execute(
+            "SELECT 1 FROM threads WHERE thread_id = ? AND user_id = ?",
+            (thread_id, user_id)
+        ).fetchone()
+    return row is not None
+
+
+# ----------------------------------------------------------------------
+# Media Blob Helpers (content-addressed, deduplicated)
+# ----------------------------------------------------------------------
+def put_media(data: bytes, mime: str = "image/png") -> str:
+    """Store image bytes once and return their hash."""
+    digest = hashlib.sha256(data).hexdigest()
+    with pool.writer() as c:
+        c.execute(INSERT_MEDIA_SQL, (digest, mime, len(data), sqlite3.Binary(data)))
+    return digest
+
+def get_media(media_hash: str) -> bytes | None:
+    with pool.reader() as c:
+        row = c.execute("SELECT data FROM media_blobs WHERE hash = ?", (media_hash,)).fetchone()
+    return bytes(row["data"]) if row else None
+
+def gc_media() -> int:
+    """Delete blobs no message references any more. Returns the number removed."""
+    with pool.writer() as c:
+        removed = c.execute(
+            """DELETE FROM media_blobs WHERE NOT EXISTS (
+                   SELECT 1 FROM thread_messages m WHERE m.media_hash = media_blobs.hash
+               )"""
+        ).rowcount
+    if removed:
+        log.info("Media GC removed %d unreferenced blobs", removed)
+    return removed
+
+
+# ----------------------------------------------------------------------
+# Full-text Search Helpers
+# ----------------------------------------------------------------------
+def _fts_query(text: str) -> str:
+    """Turn free user input into a safe FTS5 query: every word, prefix-matched, ANDed."""
+    return " ".join(f'"{w}"*' for w in re.findall(r"\w+", text))
+
+def search_threads(user_id: int, query: str, limit: int = 20) -> List[Dict]:
+    """
+    Rank a user's threads by title and message matches (BM25, titles weighted x2).
+    Each result carries a highlighted `snippet` of its best match.
+    """
+    fts = _fts_query(query)
+    if not fts:
+        return []
+    with pool.reader() as c:
+        rows = c.execute(
+            """WITH hits AS (
+                   SELECT t.thread_id, 2.0 * bm25(threads_fts) AS score,
+                          highlight(threads_fts, 0, '**', '**') AS snippet
+                   FROM threads_fts JOIN threads t ON t.rowid = threads_fts.rowid
+                   WHERE threads_fts MATCH :q AND t.user_id = :uid
+                   UNION ALL
+                   SELECT m.thread_id, bm25(messages_fts) AS score,
+                          snippet(messages_fts, 0, '**', '**', '…', 12) AS snippet
+                   FROM messages_fts
+                   JOIN thread_messages m ON m.rowid = messages_fts.rowid
+                   JOIN threads t ON t.thread_id = m.thread_id
+                   WHERE messages_fts MATCH :q AND t.user_id = :uid
+               )
+               SELECT h.thread_id, t.title, MIN(h.score) AS score, h.snippet
+               FROM hits h JOIN threads t ON t.thread_id = h.thread_id
+               GROUP BY h.thread_id
+               ORDER BY score
+               LIMIT :limit""",
+            {"q": fts, "uid": user_id, "limit": limit}
+        ).fetchall()
+    # MIN() makes SQLite return the snippet of the best-scoring hit
+    return [
+        {
+            "thread_id": r["thread_id"],
+            "title": r["title"] or "New Conversation",
+            "snippet": r["snippet"],
+            "score": r["score"],
+        }
+        for r in rows
+    ]
+
+def rebuild_search_index():
+    """Re-derive both FTS indexes from their content tables."""
+    with pool.writer() as c:
+        c.execute("INSERT INTO threads_fts(threads_fts) VALUES ('rebuild')")
+        c.execute("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')")
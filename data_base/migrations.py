@@ -0,0 +1,343 @@
+# migrations.py
+"""
+Versioned schema migrations.
+
+    python -m data_base.migrations            # apply pending migrations
+    python -m data_base.migrations status     # show current / latest version
+
+Each migration runs once, in its own write transaction (or, for VACUUM,
+outside one under a lock file next to the database, so other processes
+wait), and is recorded in `schema_version`. When the schema is current,
+upgrade() is a single read. Migrations are written to also work on
+databases created before versioning existed (columns are checked, not
+ALTERed blindly).
+"""
+import argparse
+import base64
+import hashlib
+import os
+import sqlite3
+from contextlib import contextmanager
+
+from data_base.database import pool, PREVIEW_CHARS
+
+
+MIGRATION_BATCH = 200         # rows per batch when migrations rewrite data
+
+
+# ----------------------------------------------------------------------
+# Helpers
+# ----------------------------------------------------------------------
+def _columns(c: sqlite3.Connection, table: str) -> set:
+    return {row["name"] for row in c.execute(f"PRAGMA table_info({table})").fetchall()}
+
+def _add_column(c: sqlite3.Connection, table: str, column: str, definition: str) -> bool:
+    """Add a column unless it already exists. Returns True if it was added."""
+    if column in _columns(c, table):
+        return False
+    c.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+    return True
+
+
+# ----------------------------------------------------------------------
+# Migrations
+# ----------------------------------------------------------------------
+def m001_baseline(c: sqlite3.Connection):
+    """Original users / threads / thread_messages schema."""
+    c.execute(
+        """CREATE TABLE IF NOT EXISTS users (
+               id            INTEGER PRIMARY KEY AUTOINCREMENT,
+               username      TEXT UNIQUE NOT NULL,
+               email         TEXT UNIQUE NOT NULL,
+               password_hash TEXT NOT NULL DEFAULT '',
+               first_name    TEXT,
+               last_name     TEXT,
+               created_at    TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+           )"""
+    )
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_users_username ON users(username)")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_users_email ON users(email)")
+    c.execute(
+        """CREATE TABLE IF NOT EXISTS threads (
+               thread_id     TEXT PRIMARY KEY,
+               user_id       INTEGER NOT NULL,
+               title         TEXT DEFAULT 'New Chat',
+               created_at    TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+               FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+           )"""
+    )
+    c.execute(
+        """CREATE TABLE IF NOT EXISTS thread_messages (
+               thread_id     TEXT,
+               idx           INTEGER,
+               role          TEXT CHECK(role IN ('user','assistant')),
+               content       TEXT,
+               media_b64     TEXT,
+               PRIMARY KEY (thread_id, idx),
+               FOREIGN KEY (thread_id) REFERENCES threads(thread_id) ON DELETE CASCADE
+           )"""
+    )
+    # Very old databases predate some of these columns
+    _add_column(c, "users", "password_hash", "TEXT NOT NULL DEFAULT ''")
+    _add_column(c, "users", "first_name", "TEXT")
+    _add_column(c, "users", "last_name", "TEXT")
+    _add_column(c, "users", "created_at", "TIMESTAMP")  # ALTER can't use CURRENT_TIMESTAMP
+    _add_column(c, "threads", "title", "TEXT DEFAULT 'New Chat'")
+    _add_column(c, "thread_messages", "media_b64", "TEXT")
+
+
+def m002_thread_sequence(c: sqlite3.Connection):
+    """Per-thread message sequence, seeded from existing messages."""
+    if _add_column(c, "threads", "next_idx", "INTEGER NOT NULL DEFAULT 0"):
+        c.execute(
+            """UPDATE threads SET next_idx = (
+                   SELECT COALESCE(MAX(idx), -1) + 1 FROM thread_messages m
+                   WHERE m.thread_id = threads.thread_id
+               )"""
+        )
+
+
+def m003_media_blobs(c: sqlite3.Connection):
+    """Content-addressed media; base64 columns are moved into it."""
+    c.execute(
+        """CREATE TABLE IF NOT EXISTS media_blobs (
+               hash          TEXT PRIMARY KEY,         -- sha256 of data
+               mime          TEXT NOT NULL DEFAULT 'image/png',
+               size          INTEGER NOT NULL,
+               data          BLOB NOT NULL,
+               created_at    TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+           )"""
+    )
+    _add_column(c, "thread_messages", "media_hash", "TEXT")
+    # Keyset batches: only MIGRATION_BATCH images in memory at once, and no
+    # cursor left open over rows being updated
+    last = -1
+    while True:
+        rows = c.execute(
+            """SELECT rowid, media_b64 FROM thread_messages
+               WHERE rowid > ? AND media_b64 IS NOT NULL ORDER BY rowid LIMIT ?""",
+            (last, MIGRATION_BATCH)
+        ).fetchall()
+        if not rows:
+            break
+        for r in rows:
+            data = base64.b64decode(r["media_b64"])
+            digest = hashlib.sha256(data).hexdigest()
+            c.execute(
+                "INSERT OR IGNORE INTO media_blobs (hash, size, data) VALUES (?, ?, ?)",
+                (digest, len(data), data)
+            )
+            c.execute(
+                "UPDATE thread_messages SET media_hash = ?, media_b64 = NULL WHERE rowid = ?",
+                (digest, r["rowid"])
+            )
+        last = rows[-1]["rowid"]
+    c.execute(
+        "CREATE INDEX IF NOT EXISTS idx_thread_messages_media ON thread_messages(media_hash) "
+        "WHERE media_hash IS NOT NULL"
+    )
+
+
+def m004_thread_summary(c: sqlite3.Connection):
+    """Denormalized sidebar summary (count, activity, preview)."""
+    _add_column(c, "threads", "last_activity_at", "TIMESTAMP")
+    _add_column(c, "threads", "preview", "TEXT")
+    if _add_column(c, "threads", "message_count", "INTEGER NOT NULL DEFAULT 0"):
+        c.execute(
+            """UPDATE threads SET
+                   message_count = (SELECT COUNT(*) FROM thread_messages m
+                                    WHERE m.thread_id = threads.thread_id),
+                   last_activity_at = COALESCE(last_activity_at, created_at, datetime('now')),
+                   preview = (SELECT substr(content, 1, ?) FROM thread_messages m
+                              WHERE m.thread_id = threads.thread_id
+                              ORDER BY idx DESC LIMIT 1)""",
+            (PREVIEW_CHARS,)
+        )
+    # Sidebar query: only non-empty threads, newest activity first
+    c.execute(
+        """CREATE INDEX IF NOT EXISTS idx_threads_user_activity
+           ON threads(user_id, last_activity_at DESC, thread_id DESC)
+           WHERE message_count > 0"""
+    )
+
+
+def m005_full_text_search(c: sqlite3.Connection):
+    """
+    External-content FTS5 over titles and message bodies, synced by triggers.
+    NOTE: a full VACUUM may renumber rowids – call rebuild_search_index() after one.
+    """
+    c.execute(
+        """CREATE VIRTUAL TABLE IF NOT EXISTS threads_fts USING fts5(
+               title, content='threads', content_rowid='rowid',
+               tokenize='unicode61 remove_diacritics 2'
+           )"""
+    )
+    c.execute(
+        """CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+               content, content='thread_messages', content_rowid='rowid',
+               tokenize='unicode61 remove_diacritics 2'
+           )"""
+    )
+    for table, column in (("threads", "title"), ("thread_messages", "content")):
+        fts = "threads_fts" if table == "threads" else "messages_fts"
+        c.execute(
+            f"""CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {table} BEGIN
+                    INSERT INTO {fts}(rowid, {column}) VALUES (new.rowid, new.{column});
+                END"""
+        )
+        c.execute(
+            f"""CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {table} BEGIN
+                    INSERT INTO {fts}({fts}, rowid, {column}) VALUES ('delete', old.rowid, old.{column});
+                END"""
+        )
+        c.execute(
+            f"""CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE OF {column} ON {table} BEGIN
+                    INSERT INTO {fts}({fts}, rowid, {column}) VALUES ('delete', old.rowid, old.{column});
+                    INSERT INTO {fts}(rowid, {column}) VALUES (new.rowid, new.{column});
+                END"""
+        )
+    c.execute("INSERT INTO threads_fts(threads_fts) VALUES ('rebuild')")
+    c.execute("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')")
+
+
+def m006_incremental_vacuum(c: sqlite3.Connection):
+    """
+    Switch to auto_vacuum=INCREMENTAL so compaction can hand pages back to
+    the OS (data_base.compaction). Needs a one-off full VACUUM, which may
+    renumber rowids, so the FTS indexes are rebuilt afterwards.
+    """
+    if c.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        return
+    c.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    c.execute("VACUUM")
+    c.execute("INSERT INTO threads_fts(threads_fts) VALUES ('rebuild')")
+    c.execute("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')")
+
+m006_incremental_vacuum.transactional = False  # VACUUM can't run in a transaction
+
+
+def m007_rolling_summary(c: sqlite3.Connection):
+    """Rolling summary of the oldest turns, maintained by the chat graph."""
+    _add_column(c, "threads", "summary", "TEXT")
+    _add_column(c, "threads", "summary_upto_idx", "INTEGER NOT NULL DEFAULT -1")
+
+
+def m008_caption_cache(c: sqlite3.Connection):
+    """Image captions keyed by perceptual hash (captioning.cache)."""
+    c.execute(
+        """CREATE TABLE IF NOT EXISTS caption_cache (
+               model         TEXT NOT NULL,
+               phash         INTEGER NOT NULL,         -- 64-bit dHash (signed)
+               caption       TEXT NOT NULL,
+               hits          INTEGER NOT NULL DEFAULT 0,
+               created_at    REAL NOT NULL,            -- unix time
+               last_used_at  REAL NOT NULL,
+               PRIMARY KEY (model, phash)
+           )"""
+    )
+    c.execute("CREATE INDEX IF NOT EXISTS idx_caption_cache_lru ON caption_cache(last_used_at)")
+
+
+# Ordered; never renumber or edit an applied migration – append a new one
+MIGRATIONS = [
+    (1, "baseline", m001_baseline),
+    (2, "thread_sequence", m002_thread_sequence),
+    (3, "media_blobs", m003_media_blobs),
+    (4, "thread_summary", m004_thread_summary),
+    (5, "full_text_search", m005_full_text_search),
+    (6, "incremental_vacuum", m006_incremental_vacuum),
+    (7, "rolling_summary", m007_rolling_summary),
+    (8, "caption_cache", m008_caption_cache),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+# ----------------------------------------------------------------------
+# Runner
+# ----------------------------------------------------------------------
+def _version(c: sqlite3.Connection) -> int:
+    try:
+        return c.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+    except sqlite3.OperationalError:
+        return 0  # schema_version table doesn't exist yet
+
+def current_version() -> int:
+    with pool.reader() as c:
+        return _version(c)
+
+@contextmanager
+def _process_lock():
+    """Cross-process lock for migrations that can't hold a write transaction."""
+    with open(f"{pool.path}.migrate.lock", "a+b") as f:
+        if os.name == "nt":
+            import msvcrt
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)   # gives up after ~10s
+                    break
+                except OSError:
+                    continue
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+@contextmanager
+def _exclusive():
+    # Every process runs this path under the lock file, so the version
+    # re-check below holds across processes, as BEGIN IMMEDIATE does for pool.writer()
+    with _process_lock(), pool.exclusive() as c:
+        yield c
+
+
+def upgrade() -> int:
+    """Apply pending migrations. Returns how many were applied."""
+    if current_version() >= LATEST_VERSION:
+        return 0  # fast path: one read, no write lock
+
+    applied = 0
+    for version, name, migrate in MIGRATIONS:
+        transactional = getattr(migrate, "transactional", True)
+        with (pool.writer() if transactional else _exclusive()) as c:
+            c.execute(
+                """CREATE TABLE IF NOT EXISTS schema_version (
+                       version    INTEGER PRIMARY KEY,
+                       name       TEXT NOT NULL,
+                       applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                   )"""
+            )
+            # Re-check under the lock: another process may have got here first
+            if _version(c) >= version:
+                continue
+            migrate(c)
+            c.execute("INSERT INTO schema_version (version, name) VALUES (?, ?)", (version, name))
+        applied += 1
+        print(f"[Migration] Applied {version:03d}_{name}")
+    return applied
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the chatbot database schema.")
+    parser.add_argument("command", nargs="?", default="upgrade", choices=["upgrade", "status"])
+    args = parser.parse_args()
+
+    if args.command == "status":
+        print(f"Database: {pool.path}")
+        print(f"Schema version: {current_version()} (latest {LATEST_VERSION})")
+        return
+    applied = upgrade()
+    print(f"[Migration] {applied} migration(s) applied; schema at version {current_version()}")
+
+
+if __name__ == "__main__":
+    main()
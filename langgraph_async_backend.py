@@ -0,0 +1,191 @@
+# langgraph_async_backend.py
+"""
+Async variant of the chat graph (CHAT_BACKEND=async).
+
+Same graph and state as langgraph_backend, but chat awaits
+generate_content_async(stream=True), persistence goes through
+data_base.async_database and checkpoints through AsyncSqliteSaver. All of
+it runs on one background event loop shared by the process, so concurrent
+conversations wait on the network as coroutines instead of each holding
+a thread for the length of its LLM call.
+
+Context building (history cache reads) and the rolling summary still use
+the sync helpers; they run in the loop's default executor.
+
+    async for delta in astream_reply(prompt, config): ...   # on the loop
+    for delta in stream_reply(prompt, config): ...          # from any thread
+"""
+import asyncio
+import logging
+import queue
+import threading
+import time
+
+from langchain_core.messages import HumanMessage, AIMessage, AIMessageChunk, RemoveMessage
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+from langgraph.config import get_stream_writer
+from langgraph.graph.message import REMOVE_ALL_MESSAGES
+
+from langgraph_backend import (
+    State,
+    FALLBACK_REPLY,
+    build_graph,
+    route_node as sync_route_node,
+    _thread_id,
+    _turn_rows,
+    _reply,
+    _chunk_text,
+)
+from data_base import async_database
+from llm import context_cache, response_cache, router
+from llm.context import build_context, summarize_thread
+from llm.registry import request_options
+from llm.response_cache import RESPONSE_CACHE
+from llm.resilience import policy
+
+log = logging.getLogger(__name__)
+
+
+# ----------------------------------------------------------------------
+# Nodes
+# ----------------------------------------------------------------------
+async def route_node(state: State, config: RunnableConfig):
+    return await asyncio.to_thread(sync_route_node, state, config)
+
+
+async def chat_node(state: State, config: RunnableConfig):
+    last_msg = state["messages"][-1]
+    if not isinstance(last_msg, HumanMessage):
+        return {"messages": [AIMessage(content="No user message.")]}
+
+    thread_id = _thread_id(config)
+    tier = state.get("model_tier") or router.QUALITY
+    model_name = router.model_for(tier)
+    context = state.get("context") or await asyncio.to_thread(build_context, thread_id, last_msg.content)
+    write = get_stream_writer()
+
+    lookup = None
+    if RESPONSE_CACHE:
+        args = (model_name, response_cache.context_key(context.summary, context.messages), last_msg.content)
+        # Only the semantic tier does I/O (an embedding call)
+        lookup = (await asyncio.to_thread(response_cache.cache.lookup, *args)
+                  if response_cache.cache.semantic else response_cache.cache.lookup(*args))
+        if lookup.text is not None:
+            write(AIMessageChunk(content=lookup.text))
+            return _reply(context, lookup.text)
+
+    model, contents = context_cache.model_and_contents(thread_id, context, model_name)
+    contents.append({"role": "user", "parts": [last_msg.content]})
+
+    async def generate():
+        return await _stream_reply(model, contents, write, tier)
+
+    if lookup is None:
+        text, complete = await generate()
+    else:
+        (text, complete), shared = await response_cache.aflight.do(lookup.key, generate)
+        if shared and text:
+            write(AIMessageChunk(content=text))
+        elif complete:
+            response_cache.cache.store(lookup, text)
+
+    if not complete:
+        context_cache.invalidate(thread_id)
+    if not text:
+        write(AIMessageChunk(content=FALLBACK_REPLY))
+        return {"messages": [AIMessage(content=FALLBACK_REPLY)], "summarize": False}
+    return _reply(context, text)
+
+
+async def _stream_reply(model, contents, write, tier: str):
+    parts = []
+    started, first_token = time.monotonic(), None
+    try:
+        stream = policy(f"chat-{tier}").astream(
+            lambda timeout: model.generate_content_async(
+                contents, stream=True, request_options=request_options(timeout)
+            )
+        )
+        async for chunk in stream:
+            delta = _chunk_text(chunk)
+            if delta:
+                if first_token is None:
+                    first_token = time.monotonic() - started
+                parts.append(delta)
+                write(AIMessageChunk(content=delta))
+    except Exception as e:
+        log.warning("Gemini request failed: %s", e)
+        return "".join(parts), False
+    router.record_latency(tier, first_token, time.monotonic() - started)
+    return "".join(parts), True
+
+
+async def persist_node(state: State, config: RunnableConfig):
+    await async_database.append_messages(_thread_id(config), _turn_rows(state["messages"]))
+    return {"messages": [RemoveMessage(id=REMOVE_ALL_MESSAGES)]}
+
+
+async def summarize_node(state: State, config: RunnableConfig):
+    try:
+        await asyncio.to_thread(summarize_thread, _thread_id(config))
+    except Exception:
+        log.exception("Summarizing thread %s failed", _thread_id(config))
+    return {"summarize": False}
+
+
+# ----------------------------------------------------------------------
+# Shared event loop
+# ----------------------------------------------------------------------
+_loop = asyncio.new_event_loop()
+threading.Thread(target=_loop.run_forever, name="chat-event-loop", daemon=True).start()
+
+
+def run(coro, timeout: float | None = None):
+    """Run a coroutine on the backend loop from any other thread and wait for it."""
+    return asyncio.run_coroutine_threadsafe(coro, _loop).result(timeout)
+
+
+async def _compile():
+    # aiosqlite connections belong to the loop that opened them
+    saver = AsyncSqliteSaver(await async_database.checkpointer_connection())
+    await saver.setup()
+    return build_graph(route_node, chat_node, persist_node, summarize_node).compile(checkpointer=saver)
+
+
+chatbot = run(_compile())
+
+
+async def astream_reply(prompt: str, config: RunnableConfig):
+    """Async generator of reply text deltas; must run on the backend loop."""
+    async for chunk in chatbot.astream(
+        {"messages": [HumanMessage(content=prompt)]}, config=config, stream_mode="custom"
+    ):
+        if isinstance(chunk, AIMessageChunk) and chunk.content:
+            yield chunk.content
+
+
+_DONE = object()
+
+
+def stream_reply(prompt: str, config: RunnableConfig):
+    """Sync bridge for Streamlit: yields deltas produced on the backend loop."""
+    deltas = queue.Queue()
+
+    async def pump():
+        try:
+            async for delta in astream_reply(prompt, config):
+                deltas.put(delta)
+        except BaseException as e:
+            deltas.put(e)
+        finally:
+            deltas.put(_DONE)
+
+    future = asyncio.run_coroutine_threadsafe(pump(), _loop)
+    try:
+        while (item := deltas.get()) is not _DONE:
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        future.cancel()  # consumer went away (e.g. Streamlit rerun): stop the turn
@@ -1,46 +1,216 @@
 # langgraph_backend.py
+import logging
 import os
+import time
 from dotenv import load_dotenv
 from typing import TypedDict, Annotated, List
 from langgraph.graph import StateGraph, START, END
+from langgraph.channels.untracked_value import UntrackedValue
 from langgraph.checkpoint.sqlite import SqliteSaver
-from langgraph.graph.message import add_messages
-from langchain_core.messages import BaseMessage, HumanMessage, AIMessage
-import google.generativeai as genai
+from langgraph.graph.message import add_messages, REMOVE_ALL_MESSAGES
+from langchain_core.messages import BaseMessage, HumanMessage, AIMessage, AIMessageChunk, RemoveMessage
+from langchain_core.runnables import RunnableConfig
+from langgraph.config import get_stream_writer
 
 load_dotenv()
-genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+log = logging.getLogger(__name__)
 
-from data_base.database import conn  
+from llm.registry import configure, request_options, warm_up
+configure()
+
+from data_base.database import checkpointer_connection, append_messages
+from data_base.compaction import start_compactor
+from llm.context import Context, build_context, needs_summary, count_tokens, summarize_thread
+from llm import context_cache, response_cache, router
+from llm.response_cache import RESPONSE_CACHE
+from llm.resilience import policy
+
+
+# thread_messages is the single source of truth for conversation history.
+# `messages` only carries the in-flight turn: the chat node reads history
+# from the DB, the persist node writes the turn once and clears the state,
+# so checkpoints stay O(1) in conversation length.
 class State(TypedDict):
     messages: Annotated[List[BaseMessage], add_messages]
+    model_tier: str   # set by route: key into llm.router.MODEL_TIERS
+    context: Annotated[Context, UntrackedValue]   # set by route, reused by chat; never checkpointed
+    summarize: bool   # set by chat when the unsummarized history exceeds the budget
+
+
+FALLBACK_REPLY = "Sorry, I couldn't respond. Try again."
 
 
-def chat_node(state: State):
-    model = genai.GenerativeModel("gemini-2.5-flash") 
-    # Build history from full state
-    history = []
-    for msg in state["messages"]:
-        role = "user" if isinstance(msg, HumanMessage) else "model"
-        history.append({"role": role, "parts": [msg.content]})
+def _thread_id(config: RunnableConfig) -> str:
+    return config["configurable"]["thread_id"]
+
+
+def route_node(state: State, config: RunnableConfig):
+    # Local heuristics only; picks the fast or quality model for this turn.
+    # The context is built here once and handed to chat through the state.
+    last_msg = state["messages"][-1]
+    if not isinstance(last_msg, HumanMessage):
+        return {"model_tier": router.QUALITY}
+    context = build_context(_thread_id(config), last_msg.content)
+    return {"model_tier": router.route(last_msg.content, context).tier, "context": context}
+
 
-    chat = model.start_chat(history=history[:-1])  # Exclude last user message (already in send_message)
+def _turn_context(state: State, thread_id: str, prompt: str) -> Context:
+    # Untracked: missing only if the run resumed from a checkpoint after route
+    return state.get("context") or build_context(thread_id, prompt)
 
+
+def chat_node(state: State, config: RunnableConfig):
     # Get last user message
     last_msg = state["messages"][-1]
     if not isinstance(last_msg, HumanMessage):
         return {"messages": [AIMessage(content="No user message.")]}
 
+    # Rolling summary + the newest messages that fit CONTEXT_TOKEN_BUDGET.
+    # A long stable prefix is served from Gemini's context cache when one
+    # exists; the model handle is bound to it (else the shared GEMINI_MODEL one).
+    thread_id = _thread_id(config)
+    tier = state.get("model_tier") or router.QUALITY
+    model_name = router.model_for(tier)
+    context = _turn_context(state, thread_id, last_msg.content)
+    write = get_stream_writer()
+
+    # Same prompt in the same conversation: replay the earlier reply
+    lookup = None
+    if RESPONSE_CACHE:
+        lookup = response_cache.cache.lookup(
+            model_name, response_cache.context_key(context.summary, context.messages), last_msg.content
+        )
+        if lookup.text is not None:
+            write(AIMessageChunk(content=lookup.text))
+            return _reply(context, lookup.text)
+
+    model, contents = context_cache.model_and_contents(thread_id, context, model_name)
+    contents.append({"role": "user", "parts": [last_msg.content]})
+
+    def generate():
+        return _stream_reply(model, contents, write, tier)
+
+    if lookup is None:
+        text, complete = generate()
+    else:
+        # Identical requests already in flight share one model call
+        (text, complete), shared = response_cache.flight.do(lookup.key, generate)
+        if shared and text:
+            write(AIMessageChunk(content=text))
+        elif complete:
+            response_cache.cache.store(lookup, text)
+
+    if not complete:
+        context_cache.invalidate(thread_id)  # in case the provider dropped the cache
+    if not text:
+        write(AIMessageChunk(content=FALLBACK_REPLY))
+        return {"messages": [AIMessage(content=FALLBACK_REPLY)], "summarize": False}
+    return _reply(context, text)
+
+
+def _stream_reply(model, contents, write, tier: str):
+    """
+    Stream deltas to the UI (stream_mode="custom") as they arrive. Returns
+    (text, complete); on an error mid-stream the partial text is kept.
+    Retries / hedging only happen before the first chunk (llm.resilience).
+    """
+    parts = []
+    started, first_token = time.monotonic(), None
     try:
-        resp = chat.send_message(last_msg.content)
-        return {"messages": [AIMessage(content=resp.text)]}
+        stream = policy(f"chat-{tier}").stream(
+            lambda timeout: model.generate_content(
+                contents, stream=True, request_options=request_options(timeout)
+            )
+        )
+        for chunk in stream:
+            delta = _chunk_text(chunk)
+            if delta:
+                if first_token is None:
+                    first_token = time.monotonic() - started
+                parts.append(delta)
+                write(AIMessageChunk(content=delta))
     except Exception as e:
-        return {"messages": [AIMessage(content="Sorry, I couldn't respond. Try again.")]}
+        log.warning("Gemini request failed: %s", e)
+        return "".join(parts), False
+    router.record_latency(tier, first_token, time.monotonic() - started)
+    return "".join(parts), True
+
+
+def _reply(context, text: str):
+    # The assembled message is what gets checkpointed and persisted
+    context.tokens += count_tokens(text)
+    return {"messages": [AIMessage(content=text)], "summarize": needs_summary(context)}
+
+
+def _chunk_text(chunk) -> str:
+    # .text raises on chunks without text parts (e.g. the final finish_reason chunk)
+    try:
+        return chunk.text
+    except ValueError:
+        return ""
+
+
+def _turn_rows(msgs: List[BaseMessage]) -> List[dict]:
+    """This turn's messages (last user message onwards) as append_messages rows."""
+    start = max(
+        (i for i, m in enumerate(msgs) if isinstance(m, HumanMessage)), default=len(msgs) - 1
+    )
+    return [
+        {"role": "user" if isinstance(m, HumanMessage) else "assistant", "content": m.content}
+        for m in msgs[start:]
+    ]
+
+
+def persist_node(state: State, config: RunnableConfig):
+    # Write this turn in one commit
+    append_messages(_thread_id(config), _turn_rows(state["messages"]))
+    # Nothing from this turn needs to live on in the checkpoint
+    return {"messages": [RemoveMessage(id=REMOVE_ALL_MESSAGES)]}
+
+
+def summarize_node(state: State, config: RunnableConfig):
+    # Runs after the reply has streamed and been persisted
+    try:
+        summarize_thread(_thread_id(config))
+    except Exception:
+        log.exception("Summarizing thread %s failed", _thread_id(config))
+    return {"summarize": False}
+
+
+def _after_persist(state: State):
+    return "summarize" if state.get("summarize") else END
+
+
+def build_graph(route, chat, persist, summarize) -> StateGraph:
+    """route -> chat -> persist -> (summarize) -> END; shared by the sync and async backends."""
+    graph = StateGraph(State)
+    graph.add_node("route", route)
+    graph.add_node("chat", chat)
+    graph.add_node("persist", persist)
+    graph.add_node("summarize", summarize)
+    graph.add_edge(START, "route")
+    graph.add_edge("route", "chat")
+    graph.add_edge("chat", "persist")
+    graph.add_conditional_edges("persist", _after_persist, ["summarize", END])
+    graph.add_edge("summarize", END)
+    return graph
+
+
+checkpointer = SqliteSaver(conn=checkpointer_connection())
+chatbot = build_graph(route_node, chat_node, persist_node, summarize_node).compile(checkpointer=checkpointer)
+
+
+def stream_reply(prompt: str, config: RunnableConfig):
+    """Yield the assistant's reply as text deltas for one user turn."""
+    for chunk in chatbot.stream(
+        {"messages": [HumanMessage(content=prompt)]}, config=config, stream_mode="custom"
+    ):
+        if isinstance(chunk, AIMessageChunk) and chunk.content:
+            yield chunk.content
 
+# Keep the checkpoint tables bounded (CHECKPOINT_KEEP_LAST per thread)
+if os.getenv("CHECKPOINT_COMPACTION", "1") != "0":
+    start_compactor()
 
-checkpointer = SqliteSaver(conn=conn)
-graph = StateGraph(State)
-graph.add_node("chat", chat_node)
-graph.add_edge(START, "chat")
-graph.add_edge("chat", END)
-chatbot = graph.compile(checkpointer=checkpointer)
\ No newline at end of file
+# Open the Gemini channel before the first user message needs it
+warm_up(tuple(set(router.MODEL_TIERS.values())))
@@ -1,36 +1,68 @@
 import streamlit as st
 from datetime import datetime
-import time
 import sqlite3
-import uuid, re, os, base64, io
+import uuid, os, base64, io
 from io import BytesIO
 from dotenv import load_dotenv
-import google.generativeai as genai
-from langchain_core.messages import HumanMessage, AIMessage
+from llm.registry import configure as configure_gemini
+from llm.titles import provisional_title, enqueue as enqueue_title
 from streamlit_option_menu import option_menu
-from langgraph_backend import chatbot
+# CHAT_BACKEND=async serves every conversation's LLM stream from one event loop
+if os.getenv("CHAT_BACKEND", "sync") == "async":
+    from langgraph_async_backend import stream_reply
+else:
+    from langgraph_backend import stream_reply
 from auth.signup import show_signup_dialog
 from auth.signin import show_signin_dialog
 from user_profile.view_profile import show_view_profile_dialog
 from user_profile.edit_profile import show_edit_profile_dialog
 from user_profile.change_password import show_change_password_dialog
 from data_base.database import (
-    get_thread_list,
+    get_thread_summaries,
+    get_thread_title,
+    search_threads,
     create_thread,
     set_thread_title,
-    load_messages,
-    append_message,
+    load_recent_messages,
+    load_messages_before,
+    load_messages_after,
+    append_messages,
     delete_thread,
-    conn,
+    count_messages,
+    get_media,
+    thread_belongs_to_user as _thread_belongs_to_user,
 )
-from multimodel import text_to_image, image_to_text, pil_to_b64
+from data_base import migrations
+from multimodel import text_to_image, image_to_text_batch, pil_to_png_bytes
+from captioning import model as captioning_model
 from PIL import Image
 
 st.set_page_config(page_title="Gemix AI")
 load_dotenv()
+
+
+@st.cache_resource(show_spinner=False)
+def _ensure_schema():
+    # Once per process; a no-op read when the schema is current.
+    # Set DB_AUTO_MIGRATE=0 when deploys run `python -m data_base.migrations` instead.
+    if os.getenv("DB_AUTO_MIGRATE", "1") != "0":
+        migrations.upgrade()
+
+
+_ensure_schema()
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 if GEMINI_API_KEY:
-    genai.configure(api_key=GEMINI_API_KEY)
+    configure_gemini()  # once per process; re-configuring drops the warm channel
+
+
+@st.cache_resource(show_spinner=False)
+def _warm_captioner():
+    # Opt-in (CAPTION_WARMUP=1); once per process, off the script thread
+    if captioning_model.CAPTION_WARMUP:
+        captioning_model.warm_up()
+
+
+_warm_captioner()
 
 
 def is_guest_mode():
@@ -70,6 +102,9 @@ def init_session():
 
 init_session()
 
+# Messages fetched per page when opening a thread / scrolling back
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "50"))
+
 
 def download_image(img_pil: Image.Image, prefix: str = "Gemix AI"):
     buf = BytesIO()
@@ -92,43 +127,17 @@ def thread_belongs_to_user(thread_id: str, user_id: int) -> bool:
     """Return True if the thread really belongs to the logged-in user."""
     if not thread_id or is_guest_mode():
         return True
-    cur = conn.execute(
-        "SELECT 1 FROM threads WHERE thread_id = ? AND user_id = ?",
-        (thread_id, user_id),
-    )
-    return cur.fetchone() is not None
+    return _thread_belongs_to_user(thread_id, user_id)
 
 
-def generate_title(conv):
-    transcript = "\n".join(
-        f"{'You' if m['role']=='user' else 'Assistant'}: {m['content']}"
-        for m in conv[:6]
-    )
-    prompt = f"Return ONE title (3–6 words). Capitalize. No quotes.\nConversation:\n{transcript}\nTitle:"
-    if GEMINI_API_KEY:
-        try:
-            model = genai.GenerativeModel("gemini-2.5-flash")
-            resp = model.generate_content(
-                prompt,
-                generation_config=genai.GenerationConfig(
-                    temperature=0.3, max_output_tokens=15
-                ),
-            )
-            title = re.sub(r"[^\w\s]", "", resp.text.strip())
-            title = " ".join(title.split()[:6]).capitalize()
-            return title if len(title) > 3 else "New Chat"
-        except:
-            pass
-    user_msg = next((m["content"] for m in conv if m["role"] == "user"), "")
-    title = " ".join(user_msg.split()[:6]).capitalize()
-    return (title[:50] + "..." if len(title) > 50 else title) or "New Chat"
+@st.cache_data(max_entries=64, show_spinner=False)
+def _media_bytes(media_hash: str) -> bytes:
+    # Blobs are content-addressed (immutable), so caching by hash is always safe
+    return get_media(media_hash)
 
 
 def _msg_count(tid: str) -> int:
-    cur = conn.execute(
-        "SELECT COUNT(*) FROM thread_messages WHERE thread_id = ?", (tid,)
-    )
-    return cur.fetchone()[0]
+    return count_messages(tid)
 
 
 # CSS: Gradient Only | Big Main Title | Clean Sidebar
@@ -340,7 +349,17 @@ MODE = st.session_state.selected_mode
 st.sidebar.markdown("---")
 st.sidebar.header("My Chats")
 
-all_threads = [] if is_guest_mode() else get_thread_list(user_id)
+# Sidebar page size; "Show more" grows it (still one indexed query)
+SIDEBAR_PAGE_SIZE = 30
+if "sidebar_limit" not in st.session_state:
+    st.session_state.sidebar_limit = SIDEBAR_PAGE_SIZE
+
+if is_guest_mode():
+    all_threads, more_threads = [], None
+else:
+    all_threads, more_threads = get_thread_summaries(
+        user_id, limit=st.session_state.sidebar_limit
+    )
 
 search_query = st.sidebar.text_input(
     "",
@@ -353,12 +372,15 @@ if st.session_state.chat_search_input != st.session_state.chat_search:
     st.session_state.chat_search = st.session_state.chat_search_input
 
 
-filtered_threads = [
-    th
-    for th in all_threads
-    if _msg_count(th["thread_id"]) > 0
-    and (not search_query or search_query.lower() in th["title"].lower())
-]
+if search_query and not is_guest_mode():
+    # Ranked FTS over titles + message bodies; snippet replaces the preview
+    filtered_threads = [
+        {**th, "preview": th["snippet"]}
+        for th in search_threads(user_id, search_query, limit=SIDEBAR_PAGE_SIZE)
+    ]
+    more_threads = None
+else:
+    filtered_threads = all_threads
 
 if filtered_threads:
     st.sidebar.caption(
@@ -372,6 +394,7 @@ if filtered_threads:
             if st.button(
                 th["title"],
                 key=f"btn_{th['thread_id']}",
+                help=th["preview"] or None,
                 use_container_width=True,
                 type="tertiary",
             ):
@@ -379,6 +402,8 @@ if filtered_threads:
                 st.session_state.title_generated = True
                 st.session_state.confirm_delete = None
                 st.rerun()
+            if search_query and th["preview"]:
+                st.caption(th["preview"])
         with col2:
 
             if st.button(
@@ -391,6 +416,11 @@ if filtered_threads:
                 st.session_state.confirm_delete = th["thread_id"]
                 st.rerun()
 
+    if more_threads and st.sidebar.button(
+        "Show more", key="more_threads", type="tertiary", use_container_width=True
+    ):
+        st.session_state.sidebar_limit += SIDEBAR_PAGE_SIZE
+        st.rerun()
 
 elif is_guest_mode():
     st.sidebar.info("Guest Chat\nHistory not saved")
@@ -417,37 +447,68 @@ else:
 # Main Chat Area
 CONFIG = {"configurable": {"thread_id": current_thread_id}}
 
+
+def reload_messages(thread_id: str):
+    """Latest page of the thread, and whether older messages exist."""
+    if is_guest_mode():
+        st.session_state.cached_msgs = st.session_state.guest_messages
+        st.session_state.has_older_msgs = False
+    else:
+        st.session_state.cached_msgs = load_recent_messages(thread_id, HISTORY_PAGE_SIZE)
+        st.session_state.has_older_msgs = (
+            len(st.session_state.cached_msgs) == HISTORY_PAGE_SIZE
+        )
+
+
+def save_turn(thread_id: str, turn: list):
+    """Store a non-chat turn and refresh the transcript (guests keep theirs in memory)."""
+    idxs = append_messages(thread_id, turn)
+    if is_guest_mode() and idxs:
+        st.session_state.guest_messages.extend(load_messages_after(thread_id, idxs[0] - 1))
+    reload_messages(thread_id)
+
+
 if (
     "cached_msgs" not in st.session_state
     or st.session_state.get("last_thread") != current_thread_id
 ):
-    st.session_state.cached_msgs = (
-        st.session_state.guest_messages
-        if is_guest_mode()
-        else load_messages(current_thread_id)
-    )
+    reload_messages(current_thread_id)
     st.session_state.last_thread = current_thread_id
 
+# Scroll-back: pull the previous page only when asked for
+if st.session_state.get("has_older_msgs") and st.session_state.cached_msgs:
+    if st.button(
+        "Load earlier messages",
+        key=f"load_older_{current_thread_id}",
+        type="tertiary",
+        icon=":material/history:",
+        use_container_width=True,
+    ):
+        oldest_idx = st.session_state.cached_msgs[0]["idx"]
+        older = load_messages_before(current_thread_id, oldest_idx, HISTORY_PAGE_SIZE)
+        st.session_state.cached_msgs = older + st.session_state.cached_msgs
+        st.session_state.has_older_msgs = len(older) == HISTORY_PAGE_SIZE
+        st.rerun()
+
 for i, msg in enumerate(st.session_state.cached_msgs):
     with st.chat_message(msg["role"]):
         if msg.get("content"):
             st.markdown(msg["content"])
-        if msg.get("media_b64"):
-            img_data = base64.b64decode(msg["media_b64"])
+        if msg.get("media_hash"):
+            img_data = _media_bytes(msg["media_hash"])
             img = Image.open(io.BytesIO(img_data))
             st.image(img, use_container_width=True)
             if st.button(
-                "", key=f"save_hist_{i}_{current_thread_id}", icon=":material/save_alt:"
+                "",
+                key=f"save_hist_{msg.get('idx', i)}_{current_thread_id}",
+                icon=":material/save_alt:",
             ):
                 download_image(img, prefix="chat_image")
 
 # Delete Confirmation (above input)
 if st.session_state.confirm_delete and not is_guest_mode():
     tid = st.session_state.confirm_delete
-    title = next(
-        (t["title"] for t in get_thread_list(user_id) if t["thread_id"] == tid),
-        "this chat",
-    )
+    title = get_thread_title(tid) or "this chat"
 
     @st.dialog("Confirm Delete", width="small", on_dismiss="ignore")
     def delete_dialog_body(tid):
@@ -475,14 +536,15 @@ if st.session_state.confirm_delete and not is_guest_mode():
 if st.session_state.selected_mode == "Chat":
     if prompt := st.chat_input("Ask anything..."):
 
-        append_message(current_thread_id, "user", prompt)
         st.session_state.cached_msgs.append({"role": "user", "content": prompt})
         with st.chat_message("user"):
             st.markdown(prompt)
 
         if not st.session_state.title_generated:
-            title = generate_title(st.session_state.cached_msgs)
-            set_thread_title(current_thread_id, title)
+            # Instant provisional title; the LLM title arrives in the background
+            set_thread_title(current_thread_id, provisional_title(prompt))
+            if not is_guest_mode():
+                enqueue_title(current_thread_id, prompt)
             st.session_state.title_generated = True
 
         with st.chat_message("assistant"):
@@ -494,20 +556,11 @@ if st.session_state.selected_mode == "Chat":
             full_response = ""
 
             try:
-                for chunk in chatbot.stream(
-                    {"messages": [HumanMessage(content=prompt)]},
-                    config=CONFIG,
-                    stream_mode="messages",
-                ):
-                    if not chunk:
-                        continue
-
-                    msg_chunk = chunk[0][0] if isinstance(chunk[0], tuple) else chunk[0]
-
-                    if getattr(msg_chunk, "content", None):
-                        delta = msg_chunk.content
-                        full_response += delta
-                        typewriter.markdown(full_response + "▋")
+                # Real token stream: chat_node emits deltas as Gemini produces them
+                for delta in stream_reply(prompt, CONFIG):
+                    thinking.empty()
+                    full_response += delta
+                    typewriter.markdown(full_response + "▋")
 
             except Exception as e:
                 st.error(f"Chat error: {e}")
@@ -516,16 +569,12 @@ if st.session_state.selected_mode == "Chat":
             finally:
                 thinking.empty()
 
-            append_message(current_thread_id, "assistant", full_response)
+            # The graph's persist node has already written this turn
             st.session_state.cached_msgs.append(
                 {"role": "assistant", "content": full_response}
             )
 
-            if full_response.strip():
-                for i in range(len(full_response) + 1):
-                    typewriter.markdown(full_response[:i] + "▋")
-                    time.sleep(0.005)
-                typewriter.markdown(full_response)
+            typewriter.markdown(full_response)
 
         st.rerun()
 
@@ -537,19 +586,22 @@ elif st.session_state.selected_mode == "GENERATE IMAGE":
         with st.spinner("Creating image...", show_time=True):
             try:
                 img = text_to_image(img_prompt)
-                b64 = pil_to_b64(img)
+                png = pil_to_png_bytes(img)
                 with st.chat_message("assistant"):
                     st.image(img, caption="Generated Image", use_container_width=True)
                     if st.button("Save This Image", key="save_txt2img"):
                         download_image(img, prefix="generated")
-                append_message(current_thread_id, "user", img_prompt)
-                append_message(
+                save_turn(
                     current_thread_id,
-                    "assistant",
-                    "Here's your generated image:",
-                    media_b64=b64,
+                    [
+                        {"role": "user", "content": img_prompt},
+                        {
+                            "role": "assistant",
+                            "content": "Here's your generated image:",
+                            "media": png,
+                        },
+                    ],
                 )
-                st.session_state.cached_msgs = load_messages(current_thread_id)
                 st.rerun()
             except Exception as e:
                 st.error(f"Failed: {e}")
@@ -557,23 +609,37 @@ elif st.session_state.selected_mode == "GENERATE IMAGE":
 # MODE: Image to Text
 elif st.session_state.selected_mode == "GENERATE CAPTION":
     st.subheader("Upload → Get Caption ")
-    uploaded = st.file_uploader("Any image", type=["png", "jpg", "jpeg"])
+    uploaded = st.file_uploader(
+        "Any image(s)", type=["png", "jpg", "jpeg"], accept_multiple_files=True
+    )
 
     if uploaded:
-        img = Image.open(uploaded).convert("RGB")
-        st.image(img, use_container_width=True)
+        images = [Image.open(f).convert("RGB") for f in uploaded]
+        captions = st.session_state.get("image_captions", {})
+        for f, img in zip(uploaded, images):
+            st.image(img, use_container_width=True)
+            if f.file_id in captions:
+                st.code(captions[f.file_id])
 
-        if "image_caption" in st.session_state:
-            st.code(st.session_state.image_caption)
+        if not captioning_model.is_ready():
+            st.caption("The captioning model is still loading – the first caption may take a little longer.")
 
-        if st.button("Generate Caption", type="primary", width="stretch"):
+        label = "Generate Caption" if len(images) == 1 else f"Generate {len(images)} Captions"
+        if st.button(label, type="primary", width="stretch"):
             with st.spinner("Thinking..."):
-                caption = image_to_text(img)
-
-                st.session_state.image_caption = caption
-                st.session_state.cached_msgs = load_messages(current_thread_id)
-                append_message(current_thread_id, "user", "[Image]")
-                append_message(current_thread_id, "assistant", caption)
+                # One call for all uploads, so they are captioned in a single batch
+                new_captions = image_to_text_batch(images)
+
+                st.session_state.image_captions = {
+                    f.file_id: caption for f, caption in zip(uploaded, new_captions)
+                }
+                turn = []
+                for caption in new_captions:
+                    turn += [
+                        {"role": "user", "content": "[Image]"},
+                        {"role": "assistant", "content": caption},
+                    ]
+                save_turn(current_thread_id, turn)
 
             st.rerun()
 
@@ -0,0 +1,257 @@
+# context.py
+"""
+Token-budgeted conversation context with a rolling summary.
+
+Each turn sends Gemini the thread's summary (if any) plus the messages
+after `threads.summary_upto_idx`, trimmed from the oldest end to fit
+CONTEXT_TOKEN_BUDGET. Once the unsummarized tail grows past the budget,
+the graph's summarize node folds its oldest turns into the summary
+(off the reply's critical path), keeping roughly SUMMARY_KEEP_TOKENS of
+recent messages verbatim.
+
+Tokens are counted locally with tiktoken (cl100k_base – an approximation
+of Gemini's tokenizer, close enough for budgeting) or len/4 without it.
+
+Converted history is cached per thread (HISTORY_CACHE_THREADS, LRU) and
+extended incrementally: each turn only reads messages with an idx above
+the last one seen, so older turns are neither re-queried, re-tokenized
+nor re-converted. Message idx values are append-only, which is what makes
+this safe across processes.
+"""
+import logging
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import List, Dict
+
+from data_base.database import get_thread_summary, set_thread_summary, load_messages_after
+from llm.registry import get_model, request_options
+from llm.resilience import policy
+
+log = logging.getLogger(__name__)
+
+# ----------------------------------------------------------------------
+# Settings
+# ----------------------------------------------------------------------
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "8000"))
+SUMMARY_KEEP_TOKENS = int(os.getenv("SUMMARY_KEEP_TOKENS", str(CONTEXT_TOKEN_BUDGET // 2)))
+SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", "gemini-2.5-flash")
+SUMMARY_MAX_TOKENS = int(os.getenv("SUMMARY_MAX_TOKENS", "512"))
+HISTORY_CACHE_THREADS = int(os.getenv("HISTORY_CACHE_THREADS", "256"))
+MESSAGE_OVERHEAD_TOKENS = 4   # role / turn framing per message
+
+SUMMARY_PROMPT = (
+    "You maintain a running summary of a conversation between a user and an "
+    "assistant. Update the summary with the new messages below. Keep facts, "
+    "names, decisions, preferences and open questions; drop small talk. "
+    "Write at most {words} words of plain prose.\n\n"
+    "Current summary:\n{summary}\n\nNew messages:\n{transcript}\n\nUpdated summary:"
+)
+
+
+# ----------------------------------------------------------------------
+# Token counting
+# ----------------------------------------------------------------------
+_encoding = None
+_encoding_failed = False
+_encoding_lock = threading.Lock()
+
+
+def _get_encoding():
+    global _encoding, _encoding_failed
+    if _encoding is None and not _encoding_failed:
+        with _encoding_lock:  # first load may download the BPE file; do it once
+            if _encoding is None and not _encoding_failed:
+                try:
+                    import tiktoken
+                    _encoding = tiktoken.get_encoding("cl100k_base")
+                except Exception as e:  # not installed, or the BPE file can't be fetched
+                    log.warning("tiktoken unavailable, estimating tokens as chars/4: %s", e)
+                    _encoding_failed = True
+    return _encoding
+
+
+def count_tokens(text: str) -> int:
+    if not text:
+        return 0
+    enc = _get_encoding()
+    if enc is None:
+        return len(text) // 4 + 1
+    return len(enc.encode(text, disallowed_special=()))
+
+
+def message_tokens(message: Dict) -> int:
+    if "tokens" in message:
+        return message["tokens"]
+    return count_tokens(message.get("content") or "") + MESSAGE_OVERHEAD_TOKENS
+
+
+def _summary_contents(summary: str) -> List[Dict]:
+    return [
+        {"role": "user", "parts": [f"Summary of our earlier conversation:\n{summary}"]},
+        {"role": "model", "parts": ["Got it, I'll keep that in mind."]},
+    ]
+
+
+# ----------------------------------------------------------------------
+# Per-thread history cache
+# ----------------------------------------------------------------------
+@dataclass
+class _History:
+    upto_idx: int                 # summary covers idx <= upto_idx
+    summary: str | None
+    summary_tokens: int
+    messages: List[Dict] = field(default_factory=list)   # idx > upto_idx, converted
+    last_idx: int = -1
+
+
+def _convert(m: Dict) -> Dict:
+    """DB message + its token count and Gemini `contents` entry, computed once."""
+    # Gemini rejects empty parts; image-only turns get the placeholder _transcript uses
+    return {
+        **m,
+        "tokens": message_tokens(m),
+        "gemini": {"role": "user" if m["role"] == "user" else "model",
+                   "parts": [m["content"] or "[image]"]},
+    }
+
+
+class HistoryCache:
+    """LRU of converted, unsummarized history per thread, extended incrementally."""
+
+    def __init__(self, max_threads: int = HISTORY_CACHE_THREADS):
+        self.max_threads = max_threads
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, thread_id: str):
+        """Returns (summary, upto_idx, summary_tokens, messages, has_row)."""
+        row = get_thread_summary(thread_id)
+        summary, upto_idx = (row["summary"], row["upto_idx"]) if row else (None, -1)
+
+        with self._lock:
+            h = self._entries.get(thread_id)
+            if h is not None and h.upto_idx < upto_idx:
+                # Summary moved forward: keep what it didn't fold
+                h = _History(upto_idx, summary, count_tokens(summary),
+                             [m for m in h.messages if m["idx"] > upto_idx], max(h.last_idx, upto_idx))
+                self._entries[thread_id] = h
+            after = h.last_idx if h is not None else upto_idx
+
+        new = [_convert(m) for m in load_messages_after(thread_id, after)]
+
+        with self._lock:
+            h = self._entries.get(thread_id)
+            if h is None or h.upto_idx < upto_idx:
+                h = _History(upto_idx, summary, count_tokens(summary), [], upto_idx)
+            # Another turn may have extended it meanwhile
+            new = [m for m in new if m["idx"] > h.last_idx]
+            if new:
+                h.messages.extend(new)
+                h.last_idx = new[-1]["idx"]
+            self._entries[thread_id] = h
+            self._entries.move_to_end(thread_id)
+            while len(self._entries) > self.max_threads:
+                self._entries.popitem(last=False)
+            return h.summary, h.upto_idx, h.summary_tokens, list(h.messages), row is not None
+
+    def discard(self, thread_id: str):
+        with self._lock:
+            self._entries.pop(thread_id, None)
+
+
+history_cache = HistoryCache()
+
+
+# ----------------------------------------------------------------------
+# Context selection
+# ----------------------------------------------------------------------
+@dataclass
+class Context:
+    summary: str | None = None
+    messages: List[Dict] = field(default_factory=list)   # oldest first, within budget
+    tokens: int = 0               # summary + unsummarized history (before trimming)
+    summarizable: bool = False    # thread has a row to store a summary in
+    upto_idx: int = -1            # summary covers idx <= upto_idx
+
+    def to_gemini(self, after_idx: int | None = None) -> List[Dict]:
+        """
+        Gemini `contents` for the history (the new prompt is appended by the
+        caller). With after_idx, only the messages after it – the rest is
+        already in a provider-side cache.
+        """
+        if after_idx is not None:
+            return [m["gemini"] for m in self.messages if m["idx"] > after_idx]
+        contents = _summary_contents(self.summary) if self.summary else []
+        contents.extend(m["gemini"] for m in self.messages)
+        return contents
+
+
+def build_context(thread_id: str, prompt: str = "", budget: int = CONTEXT_TOKEN_BUDGET) -> Context:
+    """Summary + the newest unsummarized messages that fit the budget alongside `prompt`."""
+    summary, upto_idx, summary_tokens, history, has_row = history_cache.get(thread_id)
+
+    sizes = [m["tokens"] for m in history]
+    fixed = summary_tokens + count_tokens(prompt) + MESSAGE_OVERHEAD_TOKENS
+    total = fixed + sum(sizes)
+
+    # Drop the oldest messages until it fits; they will be folded into the summary
+    start, used = 0, total
+    while used > budget and start < len(history):
+        used -= sizes[start]
+        start += 1
+    # Don't open the window on a dangling assistant reply
+    while start < len(history) and history[start]["role"] != "user":
+        start += 1
+
+    return Context(summary, history[start:], total, has_row, upto_idx)
+
+
+def needs_summary(context: Context, budget: int = CONTEXT_TOKEN_BUDGET) -> bool:
+    return context.summarizable and context.tokens > budget
+
+
+# ----------------------------------------------------------------------
+# Rolling summary
+# ----------------------------------------------------------------------
+def _transcript(messages: List[Dict]) -> str:
+    return "\n".join(
+        f"{'User' if m['role'] == 'user' else 'Assistant'}: {m['content'] or '[image]'}"
+        for m in messages
+    )
+
+
+def summarize_thread(thread_id: str, keep_tokens: int = SUMMARY_KEEP_TOKENS) -> bool:
+    """Fold the oldest unsummarized turns into the thread summary. Returns True if updated."""
+    summary, _, _, history, has_row = history_cache.get(thread_id)
+    if not has_row:
+        return False
+
+    # Keep the newest ~keep_tokens verbatim; everything older is folded
+    kept, cut = 0, len(history)
+    while cut > 0 and kept + message_tokens(history[cut - 1]) <= keep_tokens:
+        cut -= 1
+        kept += message_tokens(history[cut])
+    # Fold whole turns: never split a user message from its reply
+    while cut < len(history) and history[cut]["role"] != "user":
+        cut += 1
+    fold = history[:cut]
+    if not fold:
+        return False
+
+    prompt = SUMMARY_PROMPT.format(
+        words=int(SUMMARY_MAX_TOKENS * 0.6),
+        summary=summary or "(none yet)",
+        transcript=_transcript(fold),
+    )
+    model = get_model(SUMMARY_MODEL, temperature=0.2, max_output_tokens=SUMMARY_MAX_TOKENS)
+    resp = policy("summary").call(
+        lambda timeout: model.generate_content(prompt, request_options=request_options(timeout))
+    )
+    new_summary = (resp.text or "").strip()
+    if not new_summary:
+        return False
+    set_thread_summary(thread_id, new_summary, fold[-1]["idx"])
+    log.info("Summarized thread %s up to idx %d", thread_id, fold[-1]["idx"])
+    return True
@@ -0,0 +1,257 @@
+# context_cache.py
+"""
+Gemini context caching for long, stable conversation prefixes.
+
+Between two rolling summaries a thread's context only grows at the end,
+so once the history window passes CONTEXT_CACHE_MIN_TOKENS it is uploaded
+once as a CachedContent and later turns send just the messages after it
+(plus the prompt) through GenerativeModel.from_cached_content(). The
+cache is keyed by the window it was built from (summary position, first
+and last message idx); a new summary or an expired TTL falls back to the
+full request for that turn.
+
+Caches are created in the background so no turn waits for the upload,
+and are refreshed once the uncached tail reaches
+CONTEXT_CACHE_REFRESH_TOKENS. Superseded, invalidated and evicted caches
+are deleted (paid storage) after DELETE_GRACE_S, so a request that picked
+one up just before can still finish with it. A thread whose window the
+provider rejects (e.g. below the model's minimum size) is retried only
+once it has grown by CONTEXT_CACHE_REFRESH_TOKENS. Create and delete
+calls are waited for at most CONTEXT_CACHE_TIMEOUT_S; a cache whose
+creation finishes after that is deleted.
+"""
+import datetime
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable, List, Dict
+
+import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
+from google.generativeai import caching
+
+from llm.context import Context, count_tokens, HISTORY_CACHE_THREADS
+from llm.registry import configure, get_model, DEFAULT_MODEL, LLM_PROVIDER, GEMINI_TIMEOUT_S
+
+log = logging.getLogger(__name__)
+
+# ----------------------------------------------------------------------
+# Settings
+# ----------------------------------------------------------------------
+CONTEXT_CACHE = os.getenv("CONTEXT_CACHE", "1") != "0" and LLM_PROVIDER != "fake"
+CONTEXT_CACHE_MIN_TOKENS = int(os.getenv("CONTEXT_CACHE_MIN_TOKENS", "2048"))   # provider minimum is lower
+CONTEXT_CACHE_REFRESH_TOKENS = int(os.getenv("CONTEXT_CACHE_REFRESH_TOKENS", "2048"))
+CONTEXT_CACHE_TTL_S = int(os.getenv("CONTEXT_CACHE_TTL_S", "600"))
+CONTEXT_CACHE_TIMEOUT_S = float(os.getenv("CONTEXT_CACHE_TIMEOUT_S", "20"))   # create / delete
+EXPIRY_MARGIN_S = 30          # don't hand out a cache that may expire mid-request
+DELETE_GRACE_S = GEMINI_TIMEOUT_S   # outlives any request that picked the cache up
+
+# Errors that mean "this model / key can't use explicit caching" – stop trying
+_UNSUPPORTED = (
+    google_exceptions.NotFound,
+    google_exceptions.PermissionDenied,
+    google_exceptions.FailedPrecondition,
+)
+
+
+@dataclass
+class _Entry:
+    model: genai.GenerativeModel
+    cached: caching.CachedContent   # deleted once superseded
+    model_name: str
+    upto_idx: int        # summary position the prefix was built on
+    start_idx: int       # first message in the prefix
+    through_idx: int     # last message in the prefix
+    tokens: int
+    expires_at: float    # time.monotonic()
+
+
+_entries = OrderedDict()     # thread_id -> _Entry
+_pending = set()
+_rejected = OrderedDict()    # thread_id -> prefix tokens the provider refused
+_unsupported_models = set()
+_lock = threading.Lock()
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="context-cache")
+_api_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="context-cache-api")
+
+_stats = {"hits": 0, "misses": 0, "created": 0, "failed": 0, "rejected": 0,
+          "deleted": 0, "cached_tokens": 0}
+
+
+def stats() -> dict:
+    with _lock:
+        return dict(_stats, threads=len(_entries), pending=len(_pending))
+
+
+def _prefix_tokens(context: Context) -> int:
+    return count_tokens(context.summary) + sum(m["tokens"] for m in context.messages)
+
+
+def _usable(thread_id: str, context: Context, model_name: str) -> _Entry | None:
+    entry = _entries.get(thread_id)
+    if entry is None or not context.messages:
+        return None
+    if (entry.model_name != model_name
+            or entry.upto_idx != context.upto_idx
+            or entry.start_idx != context.messages[0]["idx"]
+            or entry.through_idx > context.messages[-1]["idx"]
+            or entry.expires_at - EXPIRY_MARGIN_S <= time.monotonic()):
+        return None
+    return entry
+
+
+def model_and_contents(thread_id: str, context: Context, model_name: str = DEFAULT_MODEL):
+    """
+    (model, history contents) for this turn. When a cached prefix applies,
+    the model is bound to it and only the messages after it are returned.
+    """
+    if not CONTEXT_CACHE or model_name in _unsupported_models:
+        return get_model(model_name), context.to_gemini()
+
+    with _lock:
+        entry = _usable(thread_id, context, model_name)
+        if entry is not None:
+            _entries.move_to_end(thread_id)
+            _stats["hits"] += 1
+            _stats["cached_tokens"] += entry.tokens
+        else:
+            _stats["misses"] += 1
+
+    _maybe_refresh(thread_id, context, model_name, entry)
+    if entry is None:
+        return get_model(model_name), context.to_gemini()
+    return entry.model, context.to_gemini(after_idx=entry.through_idx)
+
+
+def invalidate(thread_id: str):
+    """Forget a thread's cache (e.g. the provider rejected it)."""
+    with _lock:
+        entry = _entries.pop(thread_id, None)
+    if entry is not None:
+        _retire(entry)
+
+
+# ----------------------------------------------------------------------
+# Background creation
+# ----------------------------------------------------------------------
+def _maybe_refresh(thread_id: str, context: Context, model_name: str, entry: _Entry | None):
+    if not context.messages:
+        return
+    tokens = _prefix_tokens(context)
+    if tokens < CONTEXT_CACHE_MIN_TOKENS:
+        return
+    if entry is not None and tokens - entry.tokens < CONTEXT_CACHE_REFRESH_TOKENS:
+        return
+    with _lock:
+        if thread_id in _pending:
+            return
+        if tokens - _rejected.get(thread_id, -CONTEXT_CACHE_REFRESH_TOKENS) < CONTEXT_CACHE_REFRESH_TOKENS:
+            return
+        _pending.add(thread_id)
+    _executor.submit(
+        _create, thread_id, model_name, context.to_gemini(), tokens,
+        context.upto_idx, context.messages[0]["idx"], context.messages[-1]["idx"],
+    )
+
+
+def _create(thread_id: str, model_name: str, contents: List[Dict], tokens: int,
+            upto_idx: int, start_idx: int, through_idx: int):
+    started = time.monotonic()
+    try:
+        configure()
+        cached = _bounded(
+            lambda: caching.CachedContent.create(
+                model=model_name,
+                contents=contents,
+                ttl=datetime.timedelta(seconds=CONTEXT_CACHE_TTL_S),
+            ),
+            on_late=lambda late: _executor.submit(_delete, late),   # off the API pool
+        )
+        model = genai.GenerativeModel.from_cached_content(cached)
+    except google_exceptions.InvalidArgument as e:
+        # This window (e.g. below the model's minimum size), not the model
+        log.info("Context cache for thread %s rejected: %s", thread_id, e)
+        with _lock:
+            _rejected[thread_id] = tokens
+            _rejected.move_to_end(thread_id)
+            while len(_rejected) > HISTORY_CACHE_THREADS:
+                _rejected.popitem(last=False)
+            _stats["rejected"] += 1
+        return
+    except _UNSUPPORTED as e:
+        log.warning("Context caching disabled for %s: %s", model_name, e)
+        with _lock:
+            _unsupported_models.add(model_name)
+            _stats["failed"] += 1
+        return
+    except Exception as e:
+        log.warning("Context cache for thread %s failed: %s", thread_id, e)
+        with _lock:
+            _stats["failed"] += 1
+        return
+    finally:
+        with _lock:
+            _pending.discard(thread_id)
+
+    entry = _Entry(model, cached, model_name, upto_idx, start_idx, through_idx, tokens,
+                   started + CONTEXT_CACHE_TTL_S)
+    with _lock:
+        current = _entries.get(thread_id)
+        if current is None or current.through_idx <= through_idx or current.upto_idx < upto_idx:
+            _entries[thread_id] = entry
+            _entries.move_to_end(thread_id)
+            retired = [current] if current is not None else []
+        else:
+            retired = [entry]   # a newer window won the race; this one was never used
+        _rejected.pop(thread_id, None)
+        while len(_entries) > HISTORY_CACHE_THREADS:
+            retired.append(_entries.popitem(last=False)[1])
+        _stats["created"] += 1
+    for old in retired:
+        _retire(old, delay=0 if old is entry else DELETE_GRACE_S)
+    log.info("Cached %d context tokens for thread %s", tokens, thread_id)
+
+
+# ----------------------------------------------------------------------
+# API calls / deletion
+# ----------------------------------------------------------------------
+def _bounded(fn: Callable[[], Any], on_late: Callable[[Any], None] | None = None) -> Any:
+    """
+    fn() waited for at most CONTEXT_CACHE_TIMEOUT_S (the SDK's create/delete
+    take no timeout). A result that arrives later is passed to on_late.
+    """
+    future = _api_pool.submit(fn)
+    try:
+        return future.result(timeout=CONTEXT_CACHE_TIMEOUT_S)
+    except TimeoutError:
+        if not future.cancel() and on_late is not None:
+            future.add_done_callback(
+                lambda f: f.cancelled() or f.exception() is not None or on_late(f.result())
+            )
+        raise TimeoutError(f"no response within {CONTEXT_CACHE_TIMEOUT_S:g}s") from None
+
+
+def _delete(cached: caching.CachedContent):
+    try:
+        _bounded(cached.delete)
+    except google_exceptions.NotFound:
+        pass  # already expired
+    except Exception as e:
+        log.warning("Deleting context cache %s failed (it expires on its TTL): %s", cached.name, e)
+        return
+    with _lock:
+        _stats["deleted"] += 1
+
+
+def _retire(entry: _Entry, delay: float = DELETE_GRACE_S):
+    """Delete a cache nobody will be handed again, once in-flight requests are done with it."""
+    if delay <= 0:
+        _executor.submit(_delete, entry.cached)
+        return
+    timer = threading.Timer(delay, _executor.submit, args=(_delete, entry.cached))
+    timer.daemon = True
+    timer.start()
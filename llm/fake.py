@@ -0,0 +1,123 @@
+# fake.py
+"""
+Offline stand-in for Gemini (LLM_PROVIDER=fake).
+
+FakeModel mimics the slice of GenerativeModel the app uses –
+generate_content / generate_content_async, streaming or not, and
+count_tokens – with a configurable latency profile, so the chat graph,
+checkpointer and database can be exercised (and load-tested) without
+network or API key:
+
+    FAKE_LLM_TTFT_MS            median time to first chunk (lognormal)
+    FAKE_LLM_TTFT_SIGMA         spread of that distribution
+    FAKE_LLM_REPLY_WORDS        words per reply
+    FAKE_LLM_CHUNK_WORDS        words per streamed chunk
+    FAKE_LLM_CHUNK_INTERVAL_MS  gap between chunks
+    FAKE_LLM_ERROR_RATE         share of requests failing with 503 before the first chunk
+    FAKE_LLM_SLOW_RATE          share of requests stalling before the first chunk
+    FAKE_LLM_SLOW_MS            how long such a request stalls (a slow tail, for hedging)
+    FAKE_LLM_SEED               for reproducible runs
+"""
+import asyncio
+import json
+import math
+import os
+import random
+import threading
+import time
+from types import SimpleNamespace
+
+from google.api_core import exceptions as google_exceptions
+
+# ----------------------------------------------------------------------
+# Settings
+# ----------------------------------------------------------------------
+FAKE_LLM_TTFT_MS = float(os.getenv("FAKE_LLM_TTFT_MS", "400"))
+FAKE_LLM_TTFT_SIGMA = float(os.getenv("FAKE_LLM_TTFT_SIGMA", "0.5"))
+FAKE_LLM_REPLY_WORDS = int(os.getenv("FAKE_LLM_REPLY_WORDS", "60"))
+FAKE_LLM_CHUNK_WORDS = int(os.getenv("FAKE_LLM_CHUNK_WORDS", "6"))
+FAKE_LLM_CHUNK_INTERVAL_MS = float(os.getenv("FAKE_LLM_CHUNK_INTERVAL_MS", "40"))
+FAKE_LLM_ERROR_RATE = float(os.getenv("FAKE_LLM_ERROR_RATE", "0"))
+FAKE_LLM_SLOW_RATE = float(os.getenv("FAKE_LLM_SLOW_RATE", "0"))
+FAKE_LLM_SLOW_MS = float(os.getenv("FAKE_LLM_SLOW_MS", "2000"))
+
+_WORDS = (
+    "the quick answer depends on context but in short you can think of it as a "
+    "sequence of small steps each building on the previous one until the result "
+    "is clear and easy to verify"
+).split()
+
+_rng = random.Random(os.getenv("FAKE_LLM_SEED"))
+_rng_lock = threading.Lock()
+
+
+def _plan(timeout: float | None):
+    """(ttft seconds, chunks) for one request; raises like the real API would."""
+    with _rng_lock:
+        fail = _rng.random() < FAKE_LLM_ERROR_RATE
+        ttft = FAKE_LLM_TTFT_MS / 1000 * math.exp(_rng.gauss(0, FAKE_LLM_TTFT_SIGMA))
+        if _rng.random() < FAKE_LLM_SLOW_RATE:
+            ttft += FAKE_LLM_SLOW_MS / 1000
+        start = _rng.randrange(len(_WORDS))
+    if fail:
+        return ttft, google_exceptions.ServiceUnavailable("fake provider: 503")
+    if timeout is not None and ttft > timeout:
+        return timeout, google_exceptions.DeadlineExceeded("fake provider: deadline exceeded")
+    words = [_WORDS[(start + i) % len(_WORDS)] for i in range(FAKE_LLM_REPLY_WORDS)]
+    n = max(1, FAKE_LLM_CHUNK_WORDS)
+    chunks = [" ".join(words[i:i + n]) + " " for i in range(0, len(words), n)]
+    return ttft, chunks
+
+
+def _chunk(text: str):
+    return SimpleNamespace(text=text)
+
+
+class FakeModel:
+    def __init__(self, model_name: str = "fake", system_instruction=None, generation_config=None):
+        self.model_name = model_name
+        self._generation_config = generation_config or {}
+
+    def _json_mode(self) -> bool:
+        return self._generation_config.get("response_mime_type") == "application/json"
+
+    # -- sync ----------------------------------------------------------
+    def generate_content(self, contents, stream: bool = False, request_options=None, **kwargs):
+        ttft, chunks = _plan((request_options or {}).get("timeout"))
+        time.sleep(ttft)
+        if isinstance(chunks, Exception):
+            raise chunks
+        if self._json_mode():
+            return _chunk(json.dumps({}))
+        if not stream:
+            return _chunk("".join(chunks))
+        return self._stream(chunks)
+
+    @staticmethod
+    def _stream(chunks):
+        yield _chunk(chunks[0])
+        for text in chunks[1:]:
+            time.sleep(FAKE_LLM_CHUNK_INTERVAL_MS / 1000)
+            yield _chunk(text)
+
+    # -- async ---------------------------------------------------------
+    async def generate_content_async(self, contents, stream: bool = False, request_options=None, **kwargs):
+        ttft, chunks = _plan((request_options or {}).get("timeout"))
+        await asyncio.sleep(ttft)
+        if isinstance(chunks, Exception):
+            raise chunks
+        if self._json_mode():
+            return _chunk(json.dumps({}))
+        if not stream:
+            return _chunk("".join(chunks))
+        return self._astream(chunks)
+
+    @staticmethod
+    async def _astream(chunks):
+        yield _chunk(chunks[0])
+        for text in chunks[1:]:
+            await asyncio.sleep(FAKE_LLM_CHUNK_INTERVAL_MS / 1000)
+            yield _chunk(text)
+
+    def count_tokens(self, contents, request_options=None):
+        return SimpleNamespace(total_tokens=len(str(contents)) // 4)
@@ -0,0 +1,92 @@
+# registry.py
+"""
+Process-wide Gemini client / model registry.
+
+genai.configure() drops every cached client (and with it the warm gRPC
+channel), so it must run once per process – not on every Streamlit rerun.
+Model handles are cached per (model name, generation config) and share
+that one transport; per turn only the request itself is paid for.
+
+LLM_PROVIDER=fake swaps in llm.fake.FakeModel (no network, no key) for
+offline runs and load tests.
+"""
+import logging
+import os
+import threading
+
+import google.generativeai as genai
+from dotenv import load_dotenv
+
+load_dotenv()
+log = logging.getLogger(__name__)
+
+# ----------------------------------------------------------------------
+# Settings
+# ----------------------------------------------------------------------
+DEFAULT_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.5-flash")
+GEMINI_TRANSPORT = os.getenv("GEMINI_TRANSPORT", "grpc")          # grpc | rest
+GEMINI_TIMEOUT_S = float(os.getenv("GEMINI_TIMEOUT_S", "60"))     # per request
+LLM_PROVIDER = os.getenv("LLM_PROVIDER", "gemini")                # gemini | fake
+
+_lock = threading.Lock()
+_configured = False
+_models = {}
+
+
+def configure() -> bool:
+    """Configure the Gemini SDK once. Returns False when no API key is set."""
+    global _configured
+    if LLM_PROVIDER == "fake":
+        return True
+    api_key = os.getenv("GEMINI_API_KEY")
+    if _configured:
+        return bool(api_key)
+    with _lock:
+        if not _configured:
+            genai.configure(api_key=api_key, transport=GEMINI_TRANSPORT)
+            _configured = True
+    return bool(api_key)
+
+
+def get_model(name: str = DEFAULT_MODEL, system_instruction: str | None = None,
+              **generation_config) -> genai.GenerativeModel:
+    """Cached GenerativeModel for this name + generation config."""
+    key = (name, system_instruction, tuple(sorted(generation_config.items())))
+    model = _models.get(key)
+    if model is None:
+        configure()
+        with _lock:
+            model = _models.get(key)
+            if model is None and LLM_PROVIDER == "fake":
+                from llm.fake import FakeModel
+                model = _models[key] = FakeModel(name, system_instruction, generation_config)
+            if model is None:
+                model = genai.GenerativeModel(
+                    name,
+                    system_instruction=system_instruction,
+                    generation_config=generation_config or None,
+                )
+                _models[key] = model
+    return model
+
+
+def request_options(timeout: float | None = None) -> dict:
+    """Per-call options (timeout in seconds) for generate_content & co."""
+    return {"timeout": timeout or GEMINI_TIMEOUT_S}
+
+
+def warm_up(names=(DEFAULT_MODEL,), background: bool = True):
+    """Open the transport ahead of the first user request (count_tokens is free)."""
+    def _warm():
+        if not configure():
+            return
+        for name in names:
+            try:
+                get_model(name).count_tokens("ping", request_options=request_options(10))
+            except Exception as e:
+                log.warning("Gemini warm-up for %s failed: %s", name, e)
+
+    if background:
+        threading.Thread(target=_warm, name="gemini-warmup", daemon=True).start()
+    else:
+        _warm()
@@ -0,0 +1,534 @@
+# resilience.py
+"""
+Retries, hedging and a circuit breaker for outbound LLM calls.
+
+Every Gemini call goes through a named Policy (policy("chat"),
+policy("title"), ...):
+
+- transient errors (429, 5xx, timeouts, dropped connections) are retried
+  with jittered exponential backoff, bounded by LLM_RETRY_ATTEMPTS and a
+  per-call deadline (LLM_DEADLINE_S); each attempt's request timeout is
+  capped to the time that is left;
+- once LLM_HEDGE_MIN_SAMPLES latencies are known, a call still running
+  after the observed p95 gets a duplicate request and the first success
+  wins (for streams: the first to deliver its first chunk). Hedges are
+  capped at LLM_HEDGE_BUDGET of calls and only use idle workers of a
+  bounded pool – nothing ever queues behind it; when no worker is free
+  the call just runs on the caller's thread, unhedged;
+- a circuit breaker shared by all Gemini policies opens after
+  LLM_BREAKER_FAILURES consecutive transient failures and fails fast with
+  CircuitOpenError for LLM_BREAKER_RESET_S, then lets one probe through.
+
+Streams are only retried / hedged before their first chunk – after that
+the caller has shown output, and errors propagate. The wait for the first
+chunk is capped like any attempt (the time left until the deadline); the
+request itself gets the full GEMINI_TIMEOUT_S so long replies aren't cut.
+
+An attempt given up on (the losing hedge, or one past its deadline) is
+cancelled if it hasn't started; a blocking request can't be interrupted,
+so otherwise its thread is let go as soon as the request returns, and a
+stream it opened is closed right away instead of being read.
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Any, AsyncIterator, Awaitable, Callable, Iterable, Iterator
+
+from google.api_core import exceptions as google_exceptions
+from tenacity import (
+    AsyncRetrying,
+    Retrying,
+    retry_if_exception,
+    stop_after_attempt,
+    stop_after_delay,
+    wait_random_exponential,
+)
+
+from llm.registry import GEMINI_TIMEOUT_S
+
+log = logging.getLogger(__name__)
+
+# ----------------------------------------------------------------------
+# Settings
+# ----------------------------------------------------------------------
+LLM_RETRY_ATTEMPTS = int(os.getenv("LLM_RETRY_ATTEMPTS", "3"))
+LLM_DEADLINE_S = float(os.getenv("LLM_DEADLINE_S", "30"))          # retries stop after this
+LLM_BACKOFF_MAX_S = float(os.getenv("LLM_BACKOFF_MAX_S", "4"))
+LLM_HEDGE = os.getenv("LLM_HEDGE", "1") != "0"
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+LLM_HEDGE_MIN_DELAY_S = float(os.getenv("LLM_HEDGE_MIN_DELAY_S", "0.5"))
+LLM_HEDGE_BUDGET = float(os.getenv("LLM_HEDGE_BUDGET", "0.1"))    # max share of calls hedged
+LLM_HEDGE_WORKERS = int(os.getenv("LLM_HEDGE_WORKERS", "16"))
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_RESET_S = float(os.getenv("LLM_BREAKER_RESET_S", "30"))
+
+TRANSIENT_ERRORS = (
+    google_exceptions.TooManyRequests,        # 429 / RESOURCE_EXHAUSTED
+    google_exceptions.InternalServerError,
+    google_exceptions.BadGateway,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.GatewayTimeout,
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.Aborted,
+    ConnectionError,
+    TimeoutError,
+)
+
+
+def is_transient(e: BaseException) -> bool:
+    return isinstance(e, TRANSIENT_ERRORS)
+
+
+class CircuitOpenError(RuntimeError):
+    """Raised instead of calling the provider while the breaker is open."""
+
+
+# ----------------------------------------------------------------------
+# Circuit breaker
+# ----------------------------------------------------------------------
+class CircuitBreaker:
+    """closed -> (N consecutive failures) -> open -> (reset_s) -> half-open -> one probe."""
+
+    def __init__(self, name: str, failures: int = LLM_BREAKER_FAILURES,
+                 reset_s: float = LLM_BREAKER_RESET_S):
+        self.name = name
+        self.failures = failures
+        self.reset_s = reset_s
+        self._lock = threading.Lock()
+        self._consecutive = 0
+        self._opened_at = None
+        self._probing = False
+        self.rejected = 0
+        self.trips = 0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state()
+
+    def _state(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        if time.monotonic() - self._opened_at >= self.reset_s:
+            return "half_open"
+        return "open"
+
+    def before_call(self):
+        with self._lock:
+            state = self._state()
+            if state == "closed":
+                return
+            if state == "half_open" and not self._probing:
+                self._probing = True   # this caller is the probe
+                return
+            self.rejected += 1
+        raise CircuitOpenError(f"{self.name} circuit open; failing fast")
+
+    def record_success(self):
+        with self._lock:
+            self._consecutive = 0
+            self._opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._consecutive += 1
+            if self._probing or (self._opened_at is None and self._consecutive >= self.failures):
+                self.trips += 1
+                self._opened_at = time.monotonic()
+                log.warning("%s circuit opened after %d failures", self.name, self._consecutive)
+            self._probing = False
+
+    def record_abandoned(self):
+        """The call was cancelled: no verdict, but free the half-open probe slot."""
+        with self._lock:
+            self._probing = False
+
+
+gemini_breaker = CircuitBreaker("gemini")
+
+
+# ----------------------------------------------------------------------
+# Latency tracking
+# ----------------------------------------------------------------------
+class LatencyTracker:
+    def __init__(self, window: int = 200):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, q: float) -> float | None:
+        with self._lock:
+            if not self._samples:
+                return None
+            ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def __len__(self):
+        return len(self._samples)
+
+
+_hedge_pool = ThreadPoolExecutor(max_workers=LLM_HEDGE_WORKERS, thread_name_prefix="llm-hedge")
+_hedge_slots = threading.BoundedSemaphore(LLM_HEDGE_WORKERS)
+
+
+def _submit_idle(fn: Callable[[], Any]):
+    """Run fn on an idle hedge worker; None if all are busy (work is never queued)."""
+    if not _hedge_slots.acquire(blocking=False):
+        return None
+    try:
+        future = _hedge_pool.submit(fn)
+    except BaseException:
+        _hedge_slots.release()
+        raise
+    future.add_done_callback(lambda _: _hedge_slots.release())
+    return future
+
+
+def _spawn(fn: Callable[[], Any]) -> Future:
+    """Run fn on a thread of its own (a deadline must hold even when the pool is busy)."""
+    future = Future()
+
+    def run():
+        if future.set_running_or_notify_cancel():
+            try:
+                future.set_result(fn())
+            except BaseException as e:
+                future.set_exception(e)
+
+    threading.Thread(target=run, name="llm-bounded", daemon=True).start()
+    return future
+
+
+# ----------------------------------------------------------------------
+# Policy
+# ----------------------------------------------------------------------
+class Policy:
+    def __init__(self, name: str, attempts: int = LLM_RETRY_ATTEMPTS,
+                 deadline_s: float = LLM_DEADLINE_S, hedge: bool = LLM_HEDGE,
+                 breaker: CircuitBreaker = gemini_breaker):
+        self.name = name
+        self.attempts = attempts
+        self.deadline_s = deadline_s
+        self.hedge = hedge
+        self.breaker = breaker
+        self.latency = LatencyTracker()
+        self._stats = {"calls": 0, "retries": 0, "hedges": 0, "hedge_wins": 0,
+                       "hedges_skipped": 0, "abandoned": 0, "failures": 0, "rejected": 0}
+        self._lock = threading.Lock()
+
+    # -- helpers -------------------------------------------------------
+    def _count(self, key: str):
+        with self._lock:
+            self._stats[key] += 1
+
+    def _hedge_delay(self) -> float | None:
+        if not self.hedge or len(self.latency) < LLM_HEDGE_MIN_SAMPLES:
+            return None
+        return max(LLM_HEDGE_MIN_DELAY_S, self.latency.percentile(0.95))
+
+    def _hedge_budget_left(self) -> bool:
+        with self._lock:
+            return self._stats["hedges"] < LLM_HEDGE_BUDGET * self._stats["calls"]
+
+    def _take_hedge(self) -> bool:
+        """Count a hedge if the budget allows one more."""
+        with self._lock:
+            if self._stats["hedges"] >= LLM_HEDGE_BUDGET * self._stats["calls"]:
+                self._stats["hedges_skipped"] += 1
+                return False
+            self._stats["hedges"] += 1
+            return True
+
+    def _untake_hedge(self):
+        with self._lock:
+            self._stats["hedges"] -= 1
+            self._stats["hedges_skipped"] += 1
+
+    def _abandon(self, future: Future, dispose: Callable[[Any], None] | None):
+        """Give up on an attempt: drop it if not started, else dispose of what it returns."""
+        if future.cancel():
+            return
+        self._count("abandoned")
+        if dispose is not None:
+            future.add_done_callback(
+                lambda f: f.cancelled() or f.exception() is not None or dispose(f.result())
+            )
+
+    def _retrying(self, cls=Retrying):
+        def before_sleep(state):
+            self._count("retries")
+            log.info("%s: retrying after %s", self.name, state.outcome.exception())
+        return cls(
+            stop=stop_after_attempt(self.attempts) | stop_after_delay(self.deadline_s),
+            wait=wait_random_exponential(multiplier=0.25, max=LLM_BACKOFF_MAX_S),
+            retry=retry_if_exception(is_transient),
+            before_sleep=before_sleep,
+            reraise=True,
+        )
+
+    def _timeout(self, started: float) -> float:
+        remaining = self.deadline_s - (time.monotonic() - started)
+        return max(1.0, min(GEMINI_TIMEOUT_S, remaining))
+
+    def _attempt(self, fn: Callable[[], Any], timeout: float | None = None,
+                 dispose: Callable[[Any], None] | None = None) -> Any:
+        """
+        One attempt through the breaker, hedged past p95 when enabled and
+        abandoned (DeadlineExceeded) after `timeout` if one is given.
+        dispose(result) releases what an abandoned duplicate returns.
+        """
+        self.breaker.before_call()
+        started = time.monotonic()
+        try:
+            delay = self._hedge_delay()
+            if delay is None and timeout is None:
+                result = fn()
+            else:
+                result = self._supervised(fn, delay, timeout, dispose)
+        except Exception as e:
+            # Any answer from the provider – even an error like 400 – means it is up
+            if is_transient(e):
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+            raise
+        except BaseException:
+            self.breaker.record_abandoned()
+            raise
+        self.breaker.record_success()
+        self.latency.record(time.monotonic() - started)
+        return result
+
+    def _supervised(self, fn: Callable[[], Any], delay: float | None, timeout: float | None,
+                    dispose: Callable[[Any], None] | None) -> Any:
+        # A blocking call can't be abandoned from its own thread, so a hedged
+        # or deadline-bound call runs on a worker while this thread waits.
+        # Without an idle worker a hedge is skipped (fn runs right here);
+        # a deadline still gets a thread of its own.
+        hedge = delay is not None and self._hedge_budget_left()
+        primary = _submit_idle(fn) if hedge or timeout is not None else None
+        if primary is None:
+            if timeout is None:
+                return fn()
+            primary = _spawn(fn)
+        now = time.monotonic()
+        deadline = None if timeout is None else now + timeout
+        hedge_at = now + delay if hedge else None
+        pending, backup, error = {primary}, None, None
+        try:
+            while pending:
+                waits = [t - time.monotonic() for t in (deadline, hedge_at) if t is not None]
+                done, pending = wait(pending, timeout=max(0.0, min(waits)) if waits else None,
+                                     return_when=FIRST_COMPLETED)
+                winner = None
+                for future in done:
+                    if future.exception() is not None:
+                        error = future.exception()
+                    elif winner is None:
+                        winner = future
+                    else:
+                        pending.add(future)   # a second success: disposed of below
+                if winner is not None:
+                    if winner is backup:
+                        self._count("hedge_wins")
+                    return winner.result()
+                if not pending:
+                    break
+                now = time.monotonic()
+                if deadline is not None and now >= deadline:
+                    raise google_exceptions.DeadlineExceeded(f"{self.name}: no response within {timeout:.1f}s")
+                if hedge_at is not None and now >= hedge_at:
+                    hedge_at = None
+                    if self._take_hedge():
+                        backup = _submit_idle(fn)
+                        if backup is None:
+                            self._untake_hedge()
+                        else:
+                            pending.add(backup)
+            raise error
+        finally:
+            for future in pending:
+                self._abandon(future, dispose)
+
+    # -- sync API ------------------------------------------------------
+    def call(self, fn: Callable[[float], Any]) -> Any:
+        """fn(timeout) -> result, retried / hedged / breaker-guarded."""
+        return self._call(fn, bounded=False)
+
+    def _call(self, fn: Callable[[float], Any], bounded: bool,
+              dispose: Callable[[Any], None] | None = None) -> Any:
+        # bounded: the attempt is abandoned after its timeout even if fn
+        # itself would wait longer (the first chunk of a stream)
+        self._count("calls")
+        started = time.monotonic()
+        try:
+            for attempt in self._retrying():
+                with attempt:
+                    timeout = self._timeout(started)
+                    return self._attempt(lambda: fn(timeout), timeout if bounded else None, dispose)
+        except CircuitOpenError:
+            self._count("rejected")
+            raise
+        except BaseException:
+            self._count("failures")
+            raise
+
+    def stream(self, open_stream: Callable[[float], Iterable]) -> Iterator:
+        """
+        open_stream(timeout) -> iterable of chunks. Retries and hedges until
+        the first chunk arrives; after that the stream is passed through.
+        """
+        def first_chunk(_):
+            # The request timeout covers the whole stream; the wait for this
+            # first chunk is capped by _call(bounded=True) instead
+            it = iter(open_stream(GEMINI_TIMEOUT_S))
+            return it, next(it, _END)
+
+        it, first = self._call(first_chunk, bounded=True, dispose=_close_stream)
+        try:
+            if first is _END:
+                return
+            yield first
+            yield from it
+        finally:
+            _close_stream((it, first))
+
+    # -- async API -----------------------------------------------------
+    async def _aattempt(self, fn: Callable[[], Awaitable[Any]], timeout: float | None = None) -> Any:
+        self.breaker.before_call()
+        started = time.monotonic()
+        try:
+            delay = self._hedge_delay()
+            pending = fn() if delay is None else self._ahedged(fn, delay)
+            if timeout is None:
+                result = await pending
+            else:
+                try:
+                    result = await asyncio.wait_for(pending, timeout)
+                except asyncio.TimeoutError:
+                    raise google_exceptions.DeadlineExceeded(
+                        f"{self.name}: no response within {timeout:.1f}s") from None
+        except Exception as e:
+            # Any answer from the provider – even an error like 400 – means it is up
+            if is_transient(e):
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+            raise
+        except BaseException:
+            self.breaker.record_abandoned()
+            raise
+        self.breaker.record_success()
+        self.latency.record(time.monotonic() - started)
+        return result
+
+    async def _ahedged(self, fn: Callable[[], Awaitable[Any]], delay: float) -> Any:
+        primary = asyncio.ensure_future(fn())
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if done:
+            return primary.result()
+        if not self._take_hedge():
+            return await primary
+        backup = asyncio.ensure_future(fn())
+        pending = {primary, backup}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is backup:
+                            self._count("hedge_wins")
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()   # the loser's request is actually abandoned here
+
+    async def acall(self, fn: Callable[[float], Awaitable[Any]]) -> Any:
+        """Async call(): fn(timeout) is a coroutine function."""
+        return await self._acall(fn, bounded=False)
+
+    async def _acall(self, fn: Callable[[float], Awaitable[Any]], bounded: bool) -> Any:
+        self._count("calls")
+        started = time.monotonic()
+        try:
+            async for attempt in self._retrying(AsyncRetrying):
+                with attempt:
+                    timeout = self._timeout(started)
+                    return await self._aattempt(lambda: fn(timeout), timeout if bounded else None)
+        except CircuitOpenError:
+            self._count("rejected")
+            raise
+        except BaseException:
+            self._count("failures")
+            raise
+
+    async def astream(self, open_stream: Callable[[float], Awaitable[AsyncIterator]]) -> AsyncIterator:
+        """Async stream(): open_stream(timeout) awaits to an async iterable."""
+        async def first_chunk(_):
+            it = (await open_stream(GEMINI_TIMEOUT_S)).__aiter__()
+            try:
+                return it, await it.__anext__()
+            except StopAsyncIteration:
+                return it, _END
+
+        it, first = await self._acall(first_chunk, bounded=True)
+        if first is _END:
+            return
+        yield first
+        async for chunk in it:
+            yield chunk
+
+    def stats(self) -> dict:
+        with self._lock:
+            s = dict(self._stats)
+        s["p50_s"] = self.latency.percentile(0.5)
+        s["p95_s"] = self.latency.percentile(0.95)
+        s["breaker"] = self.breaker.state
+        return s
+
+
+_END = object()
+
+
+def _close_stream(opened: tuple):
+    """Close a stream first_chunk() opened, releasing its connection."""
+    close = getattr(opened[0], "close", None)
+    if close is None:
+        return
+    try:
+        close()
+    except Exception as e:
+        log.debug("Closing an abandoned stream failed: %s", e)
+
+
+_policies = {}
+_policies_lock = threading.Lock()
+
+
+def policy(name: str, **kwargs) -> Policy:
+    """The process-wide Policy for this kind of call (created on first use)."""
+    with _policies_lock:
+        if name not in _policies:
+            _policies[name] = Policy(name, **kwargs)
+        return _policies[name]
+
+
+def stats() -> dict:
+    with _policies_lock:
+        policies = dict(_policies)
+    return {
+        "breaker": {"state": gemini_breaker.state, "trips": gemini_breaker.trips,
+                    "rejected": gemini_breaker.rejected},
+        **{name: p.stats() for name, p in policies.items()},
+    }
@@ -0,0 +1,240 @@
+# response_cache.py
+"""
+Response cache in front of the chat model.
+
+Exact tier: sha256 of (model, conversation context, normalized prompt) ->
+reply, in an in-process LRU with a TTL. The context part (summary plus the
+history window actually sent) keeps a cached "yes" from answering a
+different conversation; in practice hits are fresh threads (greetings,
+FAQs) and retries.
+
+Semantic tier (RESPONSE_CACHE_SEMANTIC=1): prompts are embedded with
+Gemini and the nearest cached prompt with the same model and context is
+reused when its cosine distance is within RESPONSE_CACHE_SEMANTIC_MAX_DISTANCE.
+Vectors live in an in-memory sqlite-vec table evicted together with the
+LRU. It costs one embedding call per exact miss, and is skipped (with a
+warning) when sqlite-vec can't be loaded.
+
+`flight` / `aflight` collapse concurrent identical requests into one
+model call (threads / the async graph's event loop).
+"""
+import hashlib
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import List
+
+import google.generativeai as genai
+
+from llm.registry import configure, request_options
+from llm.singleflight import SingleFlight, AsyncSingleFlight
+
+log = logging.getLogger(__name__)
+
+# ----------------------------------------------------------------------
+# Settings
+# ----------------------------------------------------------------------
+RESPONSE_CACHE = os.getenv("RESPONSE_CACHE", "1") != "0"
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "2048"))
+RESPONSE_CACHE_TTL_S = float(os.getenv("RESPONSE_CACHE_TTL_S", "3600"))
+RESPONSE_CACHE_SEMANTIC = os.getenv("RESPONSE_CACHE_SEMANTIC", "0") == "1"
+RESPONSE_CACHE_SEMANTIC_MAX_DISTANCE = float(os.getenv("RESPONSE_CACHE_SEMANTIC_MAX_DISTANCE", "0.08"))
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "models/text-embedding-004")
+SEMANTIC_CANDIDATES = 4
+
+
+def normalize_prompt(prompt: str) -> str:
+    """Case, whitespace and trailing punctuation don't change the answer."""
+    return re.sub(r"\s+", " ", prompt.strip().lower()).rstrip(" .!?")
+
+
+def fingerprint(*parts: str) -> str:
+    h = hashlib.sha256()
+    for part in parts:
+        h.update((part or "").encode("utf-8"))
+        h.update(b"\x1f")
+    return h.hexdigest()
+
+
+def context_key(summary: str | None, messages: List[dict]) -> str:
+    """Fingerprint of the conversation the prompt is answered in."""
+    return fingerprint(summary, *(f"{m['role']}:{m['content']}" for m in messages))
+
+
+@dataclass
+class _Entry:
+    text: str
+    expires_at: float
+    rowid: int | None = None      # row in the vector index, if embedded
+
+
+@dataclass
+class Lookup:
+    """Result of ResponseCache.lookup(); pass it back to store() on a miss."""
+    key: str
+    scope: str                    # model + context: semantic matches stay inside it
+    text: str | None = None
+    kind: str | None = None       # "exact" | "semantic" | None
+    embedding: List[float] | None = None
+
+
+class ResponseCache:
+    def __init__(self, max_entries: int = RESPONSE_CACHE_MAX_ENTRIES,
+                 ttl_s: float = RESPONSE_CACHE_TTL_S,
+                 semantic: bool = RESPONSE_CACHE_SEMANTIC,
+                 max_distance: float = RESPONSE_CACHE_SEMANTIC_MAX_DISTANCE):
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self.max_distance = max_distance
+        self._entries = OrderedDict()
+        self._keys_by_rowid = {}
+        self._next_rowid = 1
+        self._lock = threading.Lock()
+        self._vec = None
+        self._vec_dim = None
+        self._stats = {"lookups": 0, "exact_hits": 0, "semantic_hits": 0, "misses": 0,
+                       "stores": 0, "evictions": 0, "expired": 0}
+        self.semantic = semantic and self._open_vector_index()
+
+    # -- vector index --------------------------------------------------
+    def _open_vector_index(self) -> bool:
+        try:
+            import sqlite_vec
+            c = sqlite3.connect(":memory:", check_same_thread=False)
+            c.enable_load_extension(True)
+            sqlite_vec.load(c)
+            c.enable_load_extension(False)
+        except Exception as e:  # not installed, or sqlite3 built without extension loading
+            log.warning("Semantic response cache disabled, sqlite-vec unavailable: %s", e)
+            return False
+        self._vec = c
+        return True
+
+    def _embed(self, text: str) -> List[float] | None:
+        try:
+            configure()
+            return genai.embed_content(
+                model=EMBEDDING_MODEL, content=text, task_type="semantic_similarity",
+                request_options=request_options(10),
+            )["embedding"]
+        except Exception as e:
+            log.warning("Prompt embedding failed: %s", e)
+            return None
+
+    def _vec_insert(self, rowid: int, scope: str, embedding: List[float]):
+        import sqlite_vec
+        if self._vec_dim is None:
+            self._vec_dim = len(embedding)
+            self._vec.execute(
+                f"""CREATE VIRTUAL TABLE response_vec USING vec0(
+                        embedding float[{self._vec_dim}] distance_metric=cosine,
+                        scope text
+                    )"""
+            )
+        self._vec.execute(
+            "INSERT INTO response_vec (rowid, embedding, scope) VALUES (?, ?, ?)",
+            (rowid, sqlite_vec.serialize_float32(embedding), scope)
+        )
+
+    def _vec_nearest(self, scope: str, embedding: List[float]):
+        import sqlite_vec
+        if self._vec_dim is None or len(embedding) != self._vec_dim:
+            return []
+        return self._vec.execute(
+            """SELECT rowid, distance FROM response_vec
+               WHERE embedding MATCH ? AND k = ? AND scope = ?
+               ORDER BY distance""",
+            (sqlite_vec.serialize_float32(embedding), SEMANTIC_CANDIDATES, scope)
+        ).fetchall()
+
+    # -- LRU -----------------------------------------------------------
+    def _drop(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None and entry.rowid is not None:
+            self._keys_by_rowid.pop(entry.rowid, None)
+            self._vec.execute("DELETE FROM response_vec WHERE rowid = ?", (entry.rowid,))
+
+    def _alive(self, key: str) -> _Entry | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.expires_at <= time.monotonic():
+            self._drop(key)
+            self._stats["expired"] += 1
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    # -- API -----------------------------------------------------------
+    def lookup(self, model: str, context_key: str, prompt: str) -> Lookup:
+        normalized = normalize_prompt(prompt)
+        scope = fingerprint(model, context_key)
+        result = Lookup(key=fingerprint(scope, normalized), scope=scope)
+        with self._lock:
+            self._stats["lookups"] += 1
+            entry = self._alive(result.key)
+            if entry is not None:
+                self._stats["exact_hits"] += 1
+                result.text, result.kind = entry.text, "exact"
+                return result
+
+        if self.semantic and normalized:
+            result.embedding = self._embed(normalized)   # network call outside the lock
+            if result.embedding is not None:
+                with self._lock:
+                    for rowid, distance in self._vec_nearest(scope, result.embedding):
+                        if distance > self.max_distance:
+                            break
+                        entry = self._alive(self._keys_by_rowid.get(rowid, ""))
+                        if entry is not None:
+                            self._stats["semantic_hits"] += 1
+                            result.text, result.kind = entry.text, "semantic"
+                            return result
+
+        with self._lock:
+            self._stats["misses"] += 1
+        return result
+
+    def store(self, lookup: Lookup, text: str):
+        if not text:
+            return
+        with self._lock:
+            self._drop(lookup.key)
+            entry = _Entry(text, time.monotonic() + self.ttl_s)
+            if self.semantic and lookup.embedding is not None:
+                entry.rowid = self._next_rowid
+                self._next_rowid += 1
+                self._vec_insert(entry.rowid, lookup.scope, lookup.embedding)
+                self._keys_by_rowid[entry.rowid] = lookup.key
+            self._entries[lookup.key] = entry
+            self._stats["stores"] += 1
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+                self._stats["evictions"] += 1
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._entries):
+                self._drop(key)
+
+    def stats(self) -> dict:
+        with self._lock:
+            s = dict(self._stats, entries=len(self._entries), semantic=self.semantic)
+        hits = s["exact_hits"] + s["semantic_hits"]
+        s["hit_rate"] = hits / s["lookups"] if s["lookups"] else 0.0
+        s["coalesced"] = flight.coalesced + aflight.coalesced
+        return s
+
+
+cache = ResponseCache()
+flight = SingleFlight()
+aflight = AsyncSingleFlight()   # for the async graph (langgraph_async_backend)
+
+
+def stats() -> dict:
+    return cache.stats()
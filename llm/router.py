@@ -0,0 +1,134 @@
+# router.py
+"""
+Model routing for the chat graph.
+
+The route node classifies each prompt with cheap local heuristics – no
+LLM call – and picks a tier from LLM_MODEL_TIERS:
+
+    fast     short, simple prompts early in a conversation
+    quality  long prompts, code, reasoning / writing requests, image
+             attachments in the recent history, deep conversations
+
+By default the quality tier is GEMINI_MODEL (what every message used to
+get) and the fast tier the lighter model of the same family, so easy
+turns get cheaper and quicker while hard ones are unchanged. Override with
+e.g. LLM_MODEL_TIERS='{"fast": "gemini-2.5-flash", "quality": "gemini-2.5-pro"}'.
+
+route() only looks at the Context the route node builds for the turn,
+which the chat node then reuses from graph state, so routing adds no
+database reads. stats() reports decisions (and why) plus per-tier
+time-to-first-token and total latency.
+"""
+import json
+import os
+import re
+import threading
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import List
+
+from llm.context import Context, count_tokens
+from llm.registry import DEFAULT_MODEL
+from llm.resilience import LatencyTracker
+
+# ----------------------------------------------------------------------
+# Settings
+# ----------------------------------------------------------------------
+FAST, QUALITY = "fast", "quality"
+MODEL_TIERS = {
+    FAST: "gemini-2.5-flash-lite",
+    QUALITY: DEFAULT_MODEL,
+    **json.loads(os.getenv("LLM_MODEL_TIERS", "{}")),
+}
+LLM_ROUTER = os.getenv("LLM_ROUTER", "1") != "0"
+ROUTER_FAST_MAX_TOKENS = int(os.getenv("ROUTER_FAST_MAX_TOKENS", "60"))
+ROUTER_DEEP_MESSAGES = int(os.getenv("ROUTER_DEEP_MESSAGES", "12"))
+ROUTER_ATTACHMENT_WINDOW = 4      # recent messages checked for images
+
+_HARD = re.compile(
+    r"\b(explain|why|how (do|does|can|should|would)|step[- ]by[- ]step|prove|derive|"
+    r"analy[sz]e|compare|evaluate|design|architect|optimi[sz]e|debug|refactor|implement|"
+    r"algorithm|translate|summari[sz]e|essay|story|report|plan|strategy|pros and cons)\b",
+    re.IGNORECASE,
+)
+_CODE = re.compile(r"```|\bdef |\bclass |\bimport |[{}]\s*$|=>|\w+\(.*\)", re.MULTILINE)
+
+
+@dataclass
+class Route:
+    tier: str
+    model: str
+    reasons: List[str] = field(default_factory=list)
+
+
+def model_for(tier: str) -> str:
+    return MODEL_TIERS.get(tier) or MODEL_TIERS[QUALITY]
+
+
+def classify(prompt: str, history: List[dict], has_summary: bool) -> Route:
+    """Pure heuristic classification (no I/O)."""
+    reasons = []
+    if count_tokens(prompt) > ROUTER_FAST_MAX_TOKENS:
+        reasons.append("long_prompt")
+    if _CODE.search(prompt):
+        reasons.append("code")
+    if _HARD.search(prompt):
+        reasons.append("reasoning")
+    if any(m.get("media_hash") for m in history[-ROUTER_ATTACHMENT_WINDOW:]):
+        reasons.append("attachment")
+    if has_summary or len(history) >= ROUTER_DEEP_MESSAGES:
+        reasons.append("deep_conversation")
+    tier = QUALITY if reasons else FAST
+    return Route(tier, model_for(tier), reasons or ["simple"])
+
+
+# ----------------------------------------------------------------------
+# Stats
+# ----------------------------------------------------------------------
+_lock = threading.Lock()
+_decisions = Counter()
+_reasons = Counter()
+_first_token = {}
+_total = {}
+
+
+def _tracker(table: dict, tier: str) -> LatencyTracker:
+    with _lock:
+        return table.setdefault(tier, LatencyTracker(window=500))
+
+
+def route(prompt: str, context: Context) -> Route:
+    """Pick the tier for this turn (from its already-built context) and record the decision."""
+    if not LLM_ROUTER:
+        decision = Route(QUALITY, model_for(QUALITY), ["router_off"])
+    else:
+        decision = classify(prompt, context.messages, bool(context.summary))
+    with _lock:
+        _decisions[decision.tier] += 1
+        _reasons.update(decision.reasons)
+    return decision
+
+
+def record_latency(tier: str, first_token_s: float | None, total_s: float):
+    if first_token_s is not None:
+        _tracker(_first_token, tier).record(first_token_s)
+    _tracker(_total, tier).record(total_s)
+
+
+def stats() -> dict:
+    with _lock:
+        decisions, reasons = dict(_decisions), dict(_reasons)
+        tiers = set(_decisions) | set(_total)
+    n = sum(decisions.values())
+    out = {"decisions": decisions, "reasons": reasons, "tiers": {}}
+    for tier in sorted(tiers):
+        ttft, total = _tracker(_first_token, tier), _tracker(_total, tier)
+        out["tiers"][tier] = {
+            "model": model_for(tier),
+            "share": decisions.get(tier, 0) / n if n else 0.0,
+            "first_token_p50_s": ttft.percentile(0.5),
+            "first_token_p95_s": ttft.percentile(0.95),
+            "total_p50_s": total.percentile(0.5),
+            "total_p95_s": total.percentile(0.95),
+        }
+    return out
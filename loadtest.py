@@ -0,0 +1,207 @@
+# loadtest.py
+"""
+Offline load test for the chat graph.
+
+Drives the compiled `chatbot` (checkpointer, history/context code and the
+data_base write path included) with N concurrent simulated users, each
+running T turns in its own thread. The LLM is replaced by llm.fake
+(LLM_PROVIDER=fake), so it runs on a laptop with no network or API key;
+shape the model's latency with the FAKE_LLM_* variables.
+
+    python loadtest.py --users 50 --turns 5
+    python loadtest.py --users 200 --turns 3 --backend async --think-ms 500
+    FAKE_LLM_TTFT_MS=800 FAKE_LLM_ERROR_RATE=0.02 python loadtest.py
+    FAKE_LLM_SLOW_RATE=0.03 FAKE_LLM_TTFT_SIGMA=0.2 python loadtest.py --users 20 --turns 30
+        (a slow tail; compare with LLM_HEDGE=0 to see what hedging buys)
+
+Reports p50/p95/p99 turn latency and time to first token, throughput,
+failed turns, hedged LLM calls and SQLite write-lock wait / hold times. The database is a
+fresh temporary file unless --db is given.
+"""
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Concurrent load test for the chat graph (fake LLM).")
+    parser.add_argument("--users", type=int, default=20, help="concurrent simulated users")
+    parser.add_argument("--turns", type=int, default=5, help="turns per user")
+    parser.add_argument("--backend", choices=["sync", "async"], default="sync")
+    parser.add_argument("--think-ms", type=float, default=0, help="pause between a user's turns")
+    parser.add_argument("--db", help="database file (default: a temporary one)")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    return parser.parse_args()
+
+
+def _configure_env(args):
+    # Must happen before the backend (and its settings) is imported
+    os.environ["LLM_PROVIDER"] = "fake"
+    os.environ["DB_PATH"] = args.db or os.path.join(tempfile.mkdtemp(prefix="loadtest-"), "chat.db")
+    os.environ.setdefault("CHECKPOINT_COMPACTION", "0")
+
+
+# ----------------------------------------------------------------------
+# Simulated users
+# ----------------------------------------------------------------------
+def _prompt(user: int, turn: int) -> str:
+    # Unique per user and turn so the response cache never short-circuits a turn
+    return f"User {user}, question {turn}: what is a good way to get started with topic {uuid.uuid4().hex[:8]}?"
+
+
+class _Results:
+    def __init__(self):
+        from llm.resilience import LatencyTracker
+        self._lock = threading.Lock()
+        self.latency = LatencyTracker(window=1_000_000)
+        self.first_token = LatencyTracker(window=1_000_000)
+        self.turns = 0
+        self.failed = 0
+
+    def record(self, started: float, first: float | None, reply: str, error: Exception | None):
+        from langgraph_backend import FALLBACK_REPLY
+        ended = time.perf_counter()
+        with self._lock:
+            self.turns += 1
+            if error is not None or not reply or reply == FALLBACK_REPLY:
+                self.failed += 1
+                return
+        self.latency.record(ended - started)
+        if first is not None:
+            self.first_token.record(first - started)
+
+
+def _sync_user(user: int, thread_id: str, args, results: _Results):
+    from langgraph_backend import stream_reply
+    config = {"configurable": {"thread_id": thread_id}}
+    for turn in range(args.turns):
+        started, first, parts, error = time.perf_counter(), None, [], None
+        try:
+            for delta in stream_reply(_prompt(user, turn), config):
+                if first is None:
+                    first = time.perf_counter()
+                parts.append(delta)
+        except Exception as e:
+            error = e
+        results.record(started, first, "".join(parts), error)
+        if args.think_ms:
+            time.sleep(args.think_ms / 1000)
+
+
+async def _async_user(user: int, thread_id: str, args, results: _Results):
+    from langgraph_async_backend import astream_reply
+    config = {"configurable": {"thread_id": thread_id}}
+    for turn in range(args.turns):
+        started, first, parts, error = time.perf_counter(), None, [], None
+        try:
+            async for delta in astream_reply(_prompt(user, turn), config):
+                if first is None:
+                    first = time.perf_counter()
+                parts.append(delta)
+        except Exception as e:
+            error = e
+        results.record(started, first, "".join(parts), error)
+        if args.think_ms:
+            await asyncio.sleep(args.think_ms / 1000)
+
+
+def run(args) -> dict:
+    from data_base import migrations
+    from data_base.database import create_user, create_thread, pool
+    migrations.upgrade()
+
+    user_id = create_user(f"loadtest-{uuid.uuid4().hex[:8]}", f"{uuid.uuid4().hex[:8]}@loadtest.local", "loadtest")
+    thread_ids = [str(uuid.uuid4()) for _ in range(args.users)]
+    for thread_id in thread_ids:
+        create_thread(thread_id, user_id, "Load test")
+
+    results = _Results()
+    if args.backend == "async":
+        import langgraph_async_backend as backend
+        from data_base import async_database
+
+        async def all_users():
+            await asyncio.gather(*(
+                _async_user(i, thread_id, args, results) for i, thread_id in enumerate(thread_ids)
+            ))
+
+        pool.write_stats.reset()
+        async_database.pool.write_stats.reset()
+        started = time.perf_counter()
+        backend.run(all_users())
+    else:
+        import langgraph_backend  # noqa: F401  (compile the graph before timing)
+        pool.write_stats.reset()
+        started = time.perf_counter()
+        threads = [
+            threading.Thread(target=_sync_user, args=(i, thread_id, args, results), name=f"user-{i}")
+            for i, thread_id in enumerate(thread_ids)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    elapsed = time.perf_counter() - started
+
+    report = {
+        "backend": args.backend,
+        "users": args.users,
+        "turns": results.turns,
+        "failed": results.failed,
+        "elapsed_s": elapsed,
+        "throughput_turns_per_s": results.turns / elapsed if elapsed else 0.0,
+        "latency_s": {f"p{q}": results.latency.percentile(q / 100) for q in (50, 95, 99)},
+        "first_token_s": {f"p{q}": results.first_token.percentile(q / 100) for q in (50, 95, 99)},
+        "sqlite_write_lock": pool.write_stats.snapshot(),
+        "llm": _llm_stats(),
+    }
+    if args.backend == "async":
+        report["sqlite_write_lock_async"] = async_database.pool.write_stats.snapshot()
+    return report
+
+
+def _llm_stats() -> dict:
+    from llm import resilience
+    totals = {"calls": 0, "hedges": 0, "hedge_wins": 0, "abandoned": 0}
+    for name, s in resilience.stats().items():
+        if name != "breaker":
+            for key in totals:
+                totals[key] += s[key]
+    return totals
+
+
+def _print_report(report: dict):
+    def ms(v):
+        return "-" if v is None else f"{v * 1000:8.1f} ms"
+
+    print(f"backend={report['backend']}  users={report['users']}  turns={report['turns']}  "
+          f"failed={report['failed']}  elapsed={report['elapsed_s']:.2f}s  "
+          f"throughput={report['throughput_turns_per_s']:.1f} turns/s")
+    for label, key in (("turn latency", "latency_s"), ("first token", "first_token_s")):
+        p = report[key]
+        print(f"{label:>14}:  p50 {ms(p['p50'])}   p95 {ms(p['p95'])}   p99 {ms(p['p99'])}")
+    llm = report["llm"]
+    print(f"{'llm calls':>14}:  {llm['calls']}, hedged {llm['hedges']} (won {llm['hedge_wins']}), "
+          f"abandoned {llm['abandoned']}")
+    for label, key in (("sqlite writes", "sqlite_write_lock"), ("async writes", "sqlite_write_lock_async")):
+        s = report.get(key)
+        if not s:
+            continue
+        print(f"{label:>14}:  {s['transactions']} tx, lock wait total {s['wait_total_s']:.3f}s  "
+              f"p50 {ms(s['wait_p50_s'])}   p95 {ms(s['wait_p95_s'])}   p99 {ms(s['wait_p99_s'])}   "
+              f"max {ms(s['wait_max_s'])}   hold mean {ms(s['hold_mean_s'])}")
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    _configure_env(args)
+    report = run(args)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        _print_report(report)
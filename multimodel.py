@@ -1,64 +1,183 @@
 # multimodal.py
 import os,time
-import requests
+import asyncio
+import logging
+import threading
+import weakref
 from io import BytesIO
 from PIL import Image
 import base64
+import httpx
 from dotenv import load_dotenv
-import streamlit as st
-import google.generativeai as genai
-from google.cloud import vision
-from huggingface_hub import InferenceClient
-from transformers import BlipProcessor, BlipForConditionalGeneration
-from PIL import Image
-import fal_client
+from llm.registry import configure as configure_gemini
+from llm.singleflight import SingleFlight, AsyncSingleFlight
+from captioning import batcher, cache as caption_cache
 
 
 load_dotenv()
+log = logging.getLogger(__name__)
 HF_TOKEN = os.getenv("HF_TOKEN")
 HF_HEADERS = {"Authorization": f"Bearer {HF_TOKEN}"}
 
 
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 if GEMINI_API_KEY:
-    genai.configure(api_key=GEMINI_API_KEY)
+    configure_gemini()
 
 # 1. Text to Image
-def text_to_image(prompt: str, width: int = 1024, height: int = 1024) -> Image.Image:
-    API_URL = "https://router.huggingface.co/hf-inference/models/black-forest-labs/FLUX.1-schnell"
-    payload = {
+# One pooled httpx client per process (and one per event loop for the async
+# path): keep-alive + HTTP/2, so repeat requests skip the TCP/TLS handshake.
+# Concurrent identical requests share a single upstream call.
+IMAGE_API_URL = os.getenv(
+    "IMAGE_API_URL",
+    "https://router.huggingface.co/hf-inference/models/black-forest-labs/FLUX.1-schnell",
+)
+IMAGE_TIMEOUT_S = float(os.getenv("IMAGE_TIMEOUT_S", "120"))
+IMAGE_CONNECT_TIMEOUT_S = float(os.getenv("IMAGE_CONNECT_TIMEOUT_S", "10"))
+IMAGE_MAX_CONNECTIONS = int(os.getenv("IMAGE_MAX_CONNECTIONS", "20"))
+IMAGE_HTTP2 = os.getenv("IMAGE_HTTP2", "1") != "0"
+
+_image_client = None
+_image_client_lock = threading.Lock()
+_image_flight = SingleFlight()
+_async_image_clients = weakref.WeakKeyDictionary()   # event loop -> (client, flight)
+
+
+def _http2() -> bool:
+    if not IMAGE_HTTP2:
+        return False
+    try:
+        import h2  # noqa: F401  (httpx's optional HTTP/2 support)
+        return True
+    except ImportError:
+        log.warning("h2 not installed, image client falls back to HTTP/1.1 keep-alive")
+        return False
+
+
+def _client_options() -> dict:
+    return {
+        "http2": _http2(),
+        "headers": HF_HEADERS,
+        "timeout": httpx.Timeout(IMAGE_TIMEOUT_S, connect=IMAGE_CONNECT_TIMEOUT_S),
+        "limits": httpx.Limits(
+            max_connections=IMAGE_MAX_CONNECTIONS,
+            max_keepalive_connections=IMAGE_MAX_CONNECTIONS,
+            keepalive_expiry=60,
+        ),
+    }
+
+
+def _sync_image_client() -> httpx.Client:
+    global _image_client
+    if _image_client is None:
+        with _image_client_lock:
+            if _image_client is None:
+                _image_client = httpx.Client(**_client_options())
+    return _image_client
+
+
+def _async_image_client():
+    # httpx.AsyncClient (and its pool) belongs to the loop that uses it
+    loop = asyncio.get_running_loop()
+    entry = _async_image_clients.get(loop)
+    if entry is None:
+        entry = _async_image_clients[loop] = (httpx.AsyncClient(**_client_options()), AsyncSingleFlight())
+    return entry
+
+
+def _image_payload(prompt: str, width: int, height: int) -> dict:
+    return {
         "inputs": prompt,
         "parameters": {
             "width": width,
             "height": height,
-            "num_inference_steps": 28,  
+            "num_inference_steps": 28,
             "guidance_scale": 7.5
         }
     }
-    resp = requests.post(API_URL, headers=HF_HEADERS, json=payload, timeout=120)  
+
+
+def _image_bytes(resp: httpx.Response) -> bytes:
     if resp.status_code == 503:  # Model loading – common on first run
-        st.warning("Model is warming up... Please wait 1-2 minutes and try again.")
-        raise Exception("Model not ready yet")
+        raise Exception("Model is warming up... Please wait 1-2 minutes and try again.")
     resp.raise_for_status()
     image_bytes = resp.content
     if not image_bytes or len(image_bytes) < 100:
         raise Exception("Empty response from API")
+    return image_bytes
+
+
+def text_to_image(prompt: str, width: int = 1024, height: int = 1024) -> Image.Image:
+    def fetch():
+        resp = _sync_image_client().post(IMAGE_API_URL, json=_image_payload(prompt, width, height))
+        return _image_bytes(resp)
+
+    image_bytes, _ = _image_flight.do((prompt.strip(), width, height), fetch)
+    return Image.open(BytesIO(image_bytes))  # a fresh Image per caller
+
+
+async def atext_to_image(prompt: str, width: int = 1024, height: int = 1024) -> Image.Image:
+    """Async variant of text_to_image (for code running on an event loop)."""
+    client, flight = _async_image_client()
+
+    async def fetch():
+        resp = await client.post(IMAGE_API_URL, json=_image_payload(prompt, width, height))
+        return _image_bytes(resp)
+
+    image_bytes, _ = await flight.do((prompt.strip(), width, height), fetch)
     return Image.open(BytesIO(image_bytes))
 
 
 # 2. Image to Text (Caption)
-processor = BlipProcessor.from_pretrained("Salesforce/blip-image-captioning-base")
-model = BlipForConditionalGeneration.from_pretrained("Salesforce/blip-image-captioning-base")
-
+# BLIP is loaded lazily by captioning.model (warmed up in the background at boot);
+# requests from all sessions are micro-batched by captioning.batcher, and
+# re-uploaded images are answered from captioning.cache
 def image_to_text(img: Image.Image) -> str:
+    return image_to_text_batch([img])[0]
+
+def _cache_lookup(h: int | None) -> str | None:
+    # The cache only saves work: any error there falls back to BLIP
+    if h is None:
+        return None
+    try:
+        return caption_cache.lookup(h)
+    except Exception as e:
+        log.warning("Caption cache lookup failed: %s", e)
+        return None
+
+def _cache_store(h: int | None, caption: str):
+    if h is None:
+        return
     try:
-        inputs = processor(img, return_tensors="pt")
-        out = model.generate(**inputs, max_new_tokens=20)
-        caption = processor.decode(out[0], skip_special_tokens=True)
-        words = caption.split()
-        return " ".join(words[:]).strip()
-    except:
-        return "Caption failed."
+        caption_cache.store(h, caption)
+    except Exception as e:
+        log.warning("Caption cache store failed: %s", e)
+
+def image_to_text_batch(images: list[Image.Image]) -> list[str]:
+    """Captions in input order; "Caption failed." for any image that failed."""
+    hashes = caption_cache.hashes(images) if caption_cache.CAPTION_CACHE else [None] * len(images)
+    captions = [_cache_lookup(h) for h in hashes]
+    futures = {
+        i: batcher.submit(img) for i, img in enumerate(images) if captions[i] is None
+    }
+    deadline = time.monotonic() + batcher.CAPTION_TIMEOUT_S
+    for i, fut in futures.items():
+        try:
+            captions[i] = fut.result(max(0.0, deadline - time.monotonic()))
+        except Exception as e:
+            if isinstance(e, TimeoutError):
+                fut.cancel()  # nobody waits for it any more: the worker skips it
+            log.warning("Captioning failed: %s", e)
+            captions[i] = "Caption failed."
+            continue
+        _cache_store(hashes[i], captions[i])
+    return captions
+
+# Helper: PIL to PNG bytes
+def pil_to_png_bytes(img: Image.Image) -> bytes:
+    buf = BytesIO()
+    img.save(buf, format="PNG")
+    return buf.getvalue()
 
 # Helper: PIL to base64
 def pil_to_b64(img: Image.Image) -> str:
@@ -1,6 +1,6 @@
 # change_password.py
 import streamlit as st
-from data_base.database import get_user_by_id, conn
+from data_base.database import get_user_by_id, update_user_password
 import hashlib
 
 # Reuse your existing hash function from database.py
@@ -68,11 +68,7 @@ def show_change_password_dialog():
 
                 if not errors:
                     try:
-                        with conn:
-                            conn.execute(
-                                "UPDATE users SET password_hash = ? WHERE id = ?",
-                                (hash_password(new_password), user_id)
-                            )
+                        update_user_password(user_id, new_password)
                         st.success("Password changed successfully!")
                         st.rerun()
                     except Exception as e:
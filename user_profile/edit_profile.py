@@ -1,6 +1,6 @@
 # edit_profile.py
 import streamlit as st
-from data_base.database import get_user_by_id, conn
+from data_base.database import get_user_by_id, update_user_name
 import hashlib
 
 
@@ -62,15 +62,11 @@ def show_edit_profile_dialog():
                     st.error("First name is required.")
                 else:
                     try:
-                        with conn:
-                            conn.execute(
-                                "UPDATE users SET first_name = ?, last_name = ? WHERE id = ?",
-                                (
-                                    first_name.strip(),
-                                    last_name.strip() or None,
-                                    user_id,
-                                ),
-                            )
+                        update_user_name(
+                            user_id,
+                            first_name.strip(),
+                            last_name.strip() or None,
+                        )
                         # Update session instantly
                         st.session_state.user["first_name"] = first_name.strip()
                         st.session_state.user["last_name"] = last_name.strip() or None